@@ -1,21 +1,172 @@
 # planner.py
-from openai import OpenAI
-
-client = OpenAI(
-    base_url="http://10.205.85.250:1234",
-    api_key="lm-studio",
-    timeout=180
-)
-def planner_agent(topic: str) -> dict:
+import threading
+from collections import OrderedDict
+from typing import Dict, List
+
+from budget import Budget, estimate, MIN_TRUNCATED_FRACTION
+from retrieval import tokenize
+from llm_pool import get_pool
+
+PLAN_CACHE_SIZE = 128
+SESSION_OVERLAP = 0.6        # overlap at/above which a question counts as already covered
+
+# Ordered by importance; trimming for a budget keeps the first ones
+TEMPLATES = [
+    ("definition", "What is {topic}?"),
+    ("mechanism", "How does {topic} work internally?"),
+    ("tradeoffs", "What are the advantages and disadvantages of {topic}?"),
+    ("applications", "Where is {topic} commonly applied in industry?"),
+    ("terminology", "What are important terms/glossary related to {topic}?"),
+]
+
+# Words that identify a facet in a free-form (session) question
+FACET_WORDS = {
+    "definition": {"define", "definition", "meaning", "overview", "introduction", "explain"},
+    "mechanism": {"work", "works", "internally", "mechanism", "architecture", "implemented", "algorithm"},
+    "tradeoffs": {"advantages", "disadvantages", "pros", "cons", "benefits", "drawbacks", "limitations"},
+    "applications": {"applied", "applications", "industry", "uses", "used", "examples", "cases"},
+    "terminology": {"terms", "glossary", "terminology", "vocabulary", "concepts"},
+}
+_FILLER = {"tell", "me", "about", "please", "explain", "give", "can", "you", "i", "want", "know", "related",
+           "important", "commonly", "key", "most", "where"}
+
+stats = {"plans": 0, "cache_hits": 0, "questions_merged": 0, "questions_reused": 0}
+_cache: "OrderedDict[str, List[Dict]]" = OrderedDict()
+_lock = threading.Lock()
+
+
+# ---------------------------
+# Topic / question normalization
+# ---------------------------
+def normalize_topic(topic: str) -> str:
+    """Cache key: rephrasings of the same topic (filler words, case) map to one plan."""
+    return " ".join(dict.fromkeys(w for w in tokenize(topic) if w not in _FILLER))
+
+
+def question_facets(question: str) -> set:
+    """Facets a free-form question asks about ("What is X?" -> definition)."""
+    words = set(tokenize(question))
+    facets = {facet for facet, keys in FACET_WORDS.items() if words & keys}
+    if question.strip().lower().startswith(("what is", "what's", "define")):
+        facets.add("definition")
+    return facets or {"definition"}
+
+
+def _subject_words(text: str) -> List[str]:
+    facet_words = set().union(*FACET_WORDS.values())
+    return list(dict.fromkeys(w for w in tokenize(text) if w not in facet_words and w not in _FILLER))
+
+
+def overlap(item: Dict, topic: str, past_question: str) -> float:
+    """
+    0..1: how well a past question covers a planned one: the Jaccard
+    similarity of their subject words. Zero when the past question misses
+    a facet of the planned one, or when the shared subject words appear in
+    a different order ("Postgres to Oracle" vs "Oracle to Postgres").
+    """
+    if not item["facets"] <= question_facets(past_question):
+        return 0.0
+    wa, wb = _subject_words(topic), _subject_words(past_question)
+    shared = set(wa) & set(wb)
+    if not shared or [w for w in wa if w in shared] != [w for w in wb if w in shared]:
+        return 0.0
+    return len(shared) / len(set(wa) | set(wb))
+
+
+# ---------------------------
+# Plan building
+# ---------------------------
+def _build_plan(topic: str) -> List[Dict]:
+    """
+    Template questions for `topic`, scored against the ones kept before
+    them (most important first): a question the topic already makes an
+    earlier one cover (e.g. "How does it work?" when the topic itself
+    asks how X works) is folded into it.
+    """
+    plan, merged = [], 0
+    for _facet, template in TEMPLATES:
+        question = template.format(topic=topic)
+        item = {"facets": question_facets(question), "template": template}
+        covering = max(plan, key=lambda kept: overlap(item, topic, kept["question"]), default=None)
+        if covering is not None and overlap(item, topic, covering["question"]) >= SESSION_OVERLAP:
+            covering["facets"] |= item["facets"]
+            merged += 1
+            continue
+        plan.append(dict(item, question=question))
+    with _lock:
+        stats["questions_merged"] += merged
+    return [{"facets": item["facets"], "template": item["template"]} for item in plan]
+
+
+def _cached_plan(topic: str) -> List[Dict]:
+    """
+    Scored plan, cached per normalized topic. Entries hold templates and
+    the facets each one covers; questions are formatted from the caller's
+    own wording.
+    """
+    key = normalize_topic(topic) or topic.lower()
+    with _lock:
+        stats["plans"] += 1
+        if key in _cache:
+            _cache.move_to_end(key)
+            stats["cache_hits"] += 1
+            return _cache[key]
+    plan = _build_plan(topic)
+    with _lock:
+        _cache[key] = plan
+        while len(_cache) > PLAN_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return plan
+
+
+def _questions_for_budget(budget: Budget, available: int) -> int:
+    """
+    How many searcher calls fit before the writer's reserved time. The
+    searcher runs them concurrently, so they are counted in waves of the
+    endpoint pool's capacity.
+    """
+    if budget is None or budget.unlimited:
+        return available
+    needed = estimate("searcher")
+    spare = budget.remaining() - estimate("writer")
+    waves = int(max(0.0, spare) // needed)
+    # one more wave when the searcher would still run it as truncated answers
+    if spare - waves * needed >= needed * MIN_TRUNCATED_FRACTION:
+        waves += 1
+    return min(available, waves * get_pool().capacity())
+
+
+def planner_stats() -> Dict:
+    with _lock:
+        return dict(stats, cached_plans=len(_cache))
+
+
+def planner_agent(topic: str, budget: Budget = None, answered: Dict = None) -> dict:
+    """
+    answered: {question: answer} already researched in this session;
+              planned questions that overlap one of them reuse its answer
+              instead of costing another searcher call.
+    """
     topic = (topic or "").strip()
     if not topic:
-        return {"topic": "", "questions": []}
-
-    questions = [
-        f"What is {topic}?",
-        f"How does {topic} work internally?",
-        f"What are the advantages and disadvantages of {topic}?",
-        f"Where is {topic} commonly applied in industry?",
-        f"What are important terms/glossary related to {topic}?"
-    ]
-    return {"topic": topic, "questions": questions}
+        return {"topic": "", "questions": [], "reused": {}}
+
+    questions, reused = [], {}
+    for item in _cached_plan(topic):
+        match = max(answered or {}, key=lambda past: overlap(item, topic, past), default=None)
+        if match is not None and overlap(item, topic, match) >= SESSION_OVERLAP:
+            reused[match] = answered[match]
+            continue
+        questions.append(item["template"].format(topic=topic))
+    with _lock:
+        stats["questions_reused"] += len(reused)
+
+    keep = _questions_for_budget(budget, len(questions))
+    for q in questions[keep:]:
+        budget.skip("planner", q, "not planned, would exceed time budget")
+    return {"topic": topic, "questions": questions[:keep], "reused": reused}
+
+
+async def aplanner_agent(topic: str, budget: Budget = None, answered: Dict = None) -> dict:
+    """planner_agent() for coroutine callers (pure CPU, no I/O)."""
+    return planner_agent(topic, budget=budget, answered=answered)
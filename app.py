@@ -7,13 +7,12 @@ import json
 import tempfile
 import wave
 import time
+import threading
 from datetime import datetime
 from pathlib import Path
 
-from pipeline import run_langgraph_pipeline
+from pipeline import stream_pipeline
 from gtts import gTTS
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
 # Removed top-level vosk import to avoid startup crashes; import inside function when needed.
 from PyPDF2 import PdfReader
 from streamlit_mic_recorder import mic_recorder
@@ -22,16 +21,19 @@ import urllib.request
 import zipfile
 import shutil
 import stat
-from openai import OpenAI
 from llm_router import generate_response
-
-
-# Local LM Studio Client
-local_client = OpenAI(
-    base_url="http://localhost:1234/v1",
-    api_key="lm-studio",
-    timeout=180
-)
+from llm_pool import get_pool, generate
+from retrieval import format_passages
+from profiling import profile_run, profiled
+from rate_limit import limits_report
+from cancellation import CancelToken, Cancelled, cancellation_metrics
+from report_renderer import render_pdf, render_pdf_async
+from Planner import planner_stats
+from prompts import build as build_prompt, prompt_stats
+from conversation_memory import ConversationMemory
+
+# Per-rerun timing: Streamlit re-executes this file on every interaction
+_RERUN_STARTED = time.perf_counter()
 
 # Import research & writer modules
 from research_assistant import (
@@ -41,34 +43,28 @@ from research_assistant import (
     merged_research_and_web,
     web_search
 )
-from writer import writer_agent, generate_pdf as writer_generate_pdf
+from writer import writer_agent
 
 # --------------------------- FAST/WEB HELPERS ---------------------------
-def fast_summary_agent(query):
-    prompt = f"Give a fast and quick summary in fewer lines: {query}"
+def fast_summary_agent(query, cancel=None, memory=None):
     try:
-        response = local_client.chat.completions.create(
-            model="qwen2.5-7b-instruct-1m-q4",
-            messages=[{"role": "user", "content": prompt}]
-        )
-        content = response.choices[0].message.content
+        content = generate(build_prompt("fast_summary", memory=memory, query=query), cancel=cancel)
         return {"content": content, "sources": []}
     except Exception as e:
         return {"content": f"Error generating summary: {e}", "sources": []}
 
 
-def web_search_with_llm(query):
+def web_search_with_llm(query, cancel=None, memory=None):
     from research_assistant import web_search
     raw = web_search(query, max_results=7)
-    tavily_content = raw.get("content", "")
+    passages = raw.get("passages")
+    tavily_content = format_passages(passages) if passages else raw.get("content", "")
     sources = raw.get("sources", [])
-    prompt = f"Summarize the following web search results on '{query}' in a concise and informative way:\n\n{tavily_content}"
+    if passages:
+        # cited passages first, in citation order
+        sources = list(dict.fromkeys([p["url"] for p in passages if p["url"]] + sources))
     try:
-        response = local_client.chat.completions.create(
-            model="qwen2.5-7b-instruct-1m-q4",
-            messages=[{"role": "user", "content": prompt}]
-        )
-        content = response.choices[0].message.content
+        content = generate(build_prompt("web_summary", memory=memory, query=query, results=tavily_content), cancel=cancel)
         return {"content": content, "sources": sources}
     except Exception as e:
         return {"content": f"Error: {e}", "sources": sources}
@@ -82,6 +78,19 @@ VOSK_MODEL_PATH = "vosk-model"
 VOSK_MODEL_ZIP = "vosk-model-small-en-us-0.15.zip"
 VOSK_MODEL_URL = "https://alphacephei.com/vosk/models/vosk-model-small-en-us-0.15.zip"
 
+HISTORY_PAGE_SIZE = 10
+
+# --------------------------- CACHED RESOURCES ---------------------------
+# Built once per server process and shared across reruns and sessions.
+# (The LLM endpoint pool is already a module singleton: llm_pool.get_pool.)
+@st.cache_resource
+def load_vosk_model(path: str):
+    from vosk import Model as VoskModel
+    return VoskModel(path)
+
+# Run the fragment alone on its own widget interactions (older Streamlit: plain call)
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda fn: fn)
+
 # --------------------------- THEME CSS ---------------------------
 LIGHT_CSS = """
 <style>
@@ -134,6 +143,20 @@ def save_session_file(filename: str, data: dict):
     with open(path, "w", encoding="utf-8") as fh:
         json.dump(data, fh, indent=2, ensure_ascii=False)
 
+# Searcher answers kept per session so follow-ups can skip repeated questions
+SESSION_ANSWER_LIMIT = 25
+
+def remember_answers(data: dict, answers: dict):
+    known = data.setdefault("answered_questions", {})
+    for question, answer in (answers or {}).items():
+        content = (answer or {}).get("content", "")
+        if not content or content.startswith("Error:"):
+            continue
+        known.pop(question, None)
+        known[question] = {"content": content[:3000], "sources": answer.get("sources", [])}
+    for question in list(known)[:-SESSION_ANSWER_LIMIT]:
+        del known[question]
+
 def create_new_session_file():
     session_id = int(datetime.now().timestamp())
     filename = f"session_{session_id}.json"
@@ -206,7 +229,7 @@ def transcribe_audio_offline(audio_bytes):
         if not ensure_vosk_model():
             return ""
         try:
-            from vosk import Model as VoskModel, KaldiRecognizer as VoskKaldiRecognizer
+            from vosk import KaldiRecognizer as VoskKaldiRecognizer
         except Exception as e:
             st.error(f"Vosk package not available: {e}")
             return ""
@@ -223,7 +246,7 @@ def transcribe_audio_offline(audio_bytes):
             tmp_path = tmp_wav.name
 
         with wave.open(tmp_path, "rb") as wf:
-            model = VoskModel(VOSK_MODEL_PATH)
+            model = load_vosk_model(VOSK_MODEL_PATH)
             rec = VoskKaldiRecognizer(model, wf.getframerate())
             while True:
                 data = wf.readframes(4000)
@@ -237,6 +260,16 @@ def transcribe_audio_offline(audio_bytes):
         return ""
 
 # --------------------------- DOCUMENT EXTRACTION & SUMMARIZATION ---------------------------
+def profile_requested_by_url():
+    """True when the page URL carries ?profile=1, else None (ODR_PROFILE decides)."""
+    params = getattr(st, "query_params", None)
+    if params is not None:
+        value = params.get("profile")
+    else:
+        value = st.experimental_get_query_params().get("profile", [None])[0]
+    return True if str(value).lower() in ("1", "true", "yes") else None
+
+@profiled("extract_text_from_file")
 def extract_text_from_file(file):
     if file.type == "application/pdf":
         reader = PdfReader(file)
@@ -263,25 +296,70 @@ def do_tts(text, lang="en"):
     return f.name
 
 def create_pdf(text, title):
-    from io import BytesIO
-    buffer = BytesIO()
-    safe_title = (title or "session").replace(" ", "_")[:40]
-    c = canvas.Canvas(buffer, pagesize=letter)
-    y = 750
-    c.setFont("Helvetica-Bold", 14)
-    c.drawString(40, y, f"{title}")
-    y -= 30
-    c.setFont("Helvetica", 10)
-    for line in text.split("\n"):
-        if y < 50:
-            c.showPage()
-            c.setFont("Helvetica", 10)
-            y = 750
-        c.drawString(40, y, line)
-        y -= 14
-    c.save()
-    buffer.seek(0)
-    return buffer.getvalue()
+    return render_pdf(text, title or "session")
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def export_session(session_file: str, n_messages: int, title: str, _messages: list):
+    """TXT export; rebuilt only when the session or its length changes."""
+    return "\n".join([f"{m['role']}: {m['content']}" for m in _messages])
+
+def render_message(msg):
+    role_class = "user-message" if msg.get("role") == "user" else "assistant-message"
+    st.markdown(f'<div class="chat-message {role_class}">{msg.get("content", "")}</div>', unsafe_allow_html=True)
+    if msg.get("sources"):
+        with st.expander("🔍 Sources & Details"):
+            st.markdown(msg.get("sources"))
+
+@_fragment
+def render_history():
+    """Renders only the newest pages of the chat; "load older" reruns just this fragment."""
+    messages = st.session_state.session_data.get("messages", [])
+    shown = st.session_state.history_pages * HISTORY_PAGE_SIZE
+    if len(messages) > shown:
+        if st.button(f"⬆️ Load older messages ({len(messages) - shown} hidden)", key="load_older"):
+            st.session_state.history_pages += 1
+            shown += HISTORY_PAGE_SIZE
+    for msg in messages[-shown:]:
+        render_message(msg)
+
+def run_cancellable(fn, *args, cancel, ticker, **kwargs):
+    """
+    Runs fn(*args, cancel=cancel) on a worker thread. The script thread keeps
+    touching `ticker`, which lets Streamlit stop this script when the user
+    reruns (new query, mode switch) or disconnects — the token then cancels
+    the in-flight LLM work instead of letting it run to completion.
+    """
+    box = {}
+
+    def target():
+        try:
+            box["value"] = fn(*args, cancel=cancel, **kwargs)
+        except BaseException as e:
+            box["error"] = e
+
+    worker = threading.Thread(target=target, daemon=True)
+    worker.start()
+    started = time.monotonic()
+    try:
+        while worker.is_alive():
+            worker.join(0.5)
+            ticker.caption(f"⏳ {time.monotonic() - started:.0f}s")
+    finally:
+        if worker.is_alive():
+            cancel.cancel("abandoned by user")
+    ticker.empty()
+    if "error" in box:
+        raise box["error"]
+    return box["value"]
+
+def get_conversation_memory():
+    """Rolling memory bound to the current session's JSON ("memory" key)."""
+    state = st.session_state.session_data.setdefault("memory", {})
+    memory = st.session_state.get("conversation_memory")
+    if memory is None or memory.state is not state:
+        memory = ConversationMemory(state)
+        st.session_state.conversation_memory = memory
+    return memory
 
 def append_memory_log(query, answer):
     with open("memory.txt", "a", encoding="utf-8") as f:
@@ -304,6 +382,12 @@ if "theme" not in st.session_state:
 if "uploaded_doc_text" not in st.session_state:
     st.session_state.uploaded_doc_text = ""
 
+if "history_pages" not in st.session_state:
+    st.session_state.history_pages = 1
+
+if "rerun_timings" not in st.session_state:
+    st.session_state.rerun_timings = []
+
 # --------------------------- SIDEBAR ---------------------------
 with st.sidebar:
     st.markdown("### 🌗 Theme Mode")
@@ -327,6 +411,7 @@ with st.sidebar:
 
     mode = st.selectbox("Mode", ["normal", "deep research", "fast summary", "academic", "code", "web search", "research papers", "hybrid search"], index=0)
     tts_lang = st.selectbox("Voice", ["en", "hi", "fr", "es"])
+    time_budget = st.number_input("⏱️ Time budget (seconds, 0 = unlimited)", min_value=0, max_value=1800, value=0, step=15)
 
     st.subheader("💬 Sessions")
     st.markdown(f"*Current:* {st.session_state.current_session_file}")
@@ -335,6 +420,7 @@ with st.sidebar:
         st.session_state.current_session_file = create_new_session_file()
         st.session_state.session_data = load_session_file(st.session_state.current_session_file)
         st.session_state.uploaded_doc_text = ""
+        st.session_state.history_pages = 1
         st.rerun()
     if cols[1].button("💾 Save"):
         save_session_file(st.session_state.current_session_file, st.session_state.session_data)
@@ -345,6 +431,7 @@ with st.sidebar:
         st.session_state.current_session_file = files[0] if files else create_new_session_file()
         st.session_state.session_data = load_session_file(st.session_state.current_session_file)
         st.session_state.uploaded_doc_text = ""
+        st.session_state.history_pages = 1
         st.rerun()
 
     st.divider()
@@ -359,22 +446,38 @@ with st.sidebar:
 
     st.divider()
     st.subheader("📁 Export Current Session")
-    export_txt = "\n".join([f"{m['role']}: {m['content']}" for m in messages])
-    export_txt_bytes = export_txt.encode('utf-8')
-    st.download_button("Download TXT", export_txt_bytes, file_name=f"{st.session_state.session_data.get('title','session')}.txt", mime="text/plain")
-    export_pdf_bytes = create_pdf(export_txt, st.session_state.session_data.get("title", "session"))
-    st.download_button("Download PDF", export_pdf_bytes, file_name=f"{st.session_state.session_data.get('title','session')}.pdf", mime="application/pdf")
+    export_title = st.session_state.session_data.get("title", "session")
+    export_txt = export_session(st.session_state.current_session_file, len(messages), export_title, messages)
+    st.download_button("Download TXT", export_txt.encode('utf-8'), file_name=f"{export_title}.txt", mime="text/plain")
+    # The whole-session PDF grows with the session: render it only on request,
+    # so ordinary reruns (e.g. the one after each query) stay flat
+    export_key = (st.session_state.current_session_file, len(messages))
+    pdf_export = st.session_state.get("pdf_export")
+    if pdf_export is None or pdf_export[0] != export_key:
+        pdf_export = None
+        if st.button("Prepare PDF", key="prepare_pdf"):
+            with st.spinner("Rendering PDF..."):
+                pdf_export = (export_key, create_pdf(export_txt, export_title))
+            st.session_state.pdf_export = pdf_export
+    if pdf_export is not None:
+        st.download_button("Download PDF", pdf_export[1], file_name=f"{export_title}.pdf", mime="application/pdf")
+
+    st.divider()
+    with st.expander("📊 Backend limits & usage"):
+        st.json({
+            "limits": limits_report(),
+            "llm_pool": get_pool().stats(),
+            "cancellation": cancellation_metrics(),
+            "planner": planner_stats(),
+            "prompts": prompt_stats(),
+        })
+    rerun_timer = st.empty()
 
 # --------------------------- MAIN UI ---------------------------
 st.markdown('<div class="chat-container">', unsafe_allow_html=True)
 st.title("🤖 Open DeepResearch AI")
 
-for msg in st.session_state.session_data.get("messages", []):
-    role_class = "user-message" if msg.get("role") == "user" else "assistant-message"
-    st.markdown(f'<div class="chat-message {role_class}">{msg.get("content", "")}</div>', unsafe_allow_html=True)
-    if msg.get("sources"):
-        with st.expander("🔍 Sources & Details"):
-            st.markdown(msg.get("sources"))
+render_history()
 
 st.markdown('</div>', unsafe_allow_html=True)
 
@@ -411,8 +514,22 @@ elif user_query:
     else:
         final_input = user_query.strip()
 
+# --------------------------- RERUN TIMING ---------------------------
+# Render cost of this rerun, excluding any research work below; it should
+# stay flat as the session grows.
+_render_ms = (time.perf_counter() - _RERUN_STARTED) * 1000
+st.session_state.rerun_timings = (st.session_state.rerun_timings + [_render_ms])[-20:]
+rerun_timer.caption(
+    f"⏱️ Rerun: {_render_ms:.0f} ms · {len(st.session_state.session_data.get('messages', []))} messages · "
+    f"avg(last {len(st.session_state.rerun_timings)}): "
+    f"{sum(st.session_state.rerun_timings) / len(st.session_state.rerun_timings):.0f} ms"
+)
+
 # --------------------------- PROCESS & PIPELINE ---------------------------
 if final_input:
+    # Fixed-size context (summary + last turns) for follow-up queries
+    conversation = get_conversation_memory()
+    memory_block = conversation.context_block(st.session_state.session_data.get("messages", []))
     st.session_state.session_data.setdefault("messages", []).append({"role":"user","content":final_input})
     if st.session_state.session_data.get("title","New Chat") in (None,"","New Chat"):
         st.session_state.session_data["title"] = final_input[:60]
@@ -423,62 +540,119 @@ if final_input:
     final_answer = ""
     detail_text = ""
     result = None
-
-    with st.spinner("Processing..."):
+    details_shown = False
+
+    # One cancel token per run; a newer query cancels any run still in flight
+    previous = st.session_state.get("active_cancel")
+    if previous is not None:
+        previous.cancel("replaced by a new query")
+    cancel = CancelToken()
+    st.session_state.active_cancel = cancel
+    ticker = st.empty()
+
+    # ?profile=1 profiles this request; normal/code mode profiles inside the pipeline worker
+    profile_flag = profile_requested_by_url()
+    pipeline_mode = mode in ("normal", "code")
+    with st.spinner("Processing..."), profile_run(f"app-{mode}", enabled=False if pipeline_mode else profile_flag):
         try:
             if mode == "normal" or mode == "code":
-                result = run_langgraph_pipeline(final_input, mode=mode)
-                final_answer = result.get("final_text","") if result else "No response."
-                if result and isinstance(result.get("answers"), dict):
-                    for q, info in result["answers"].items():
-                        detail_text += f"### {q}\n{info.get('content','')}\n\n"
+                # Progressive rendering: each answer lands in Sources & Details
+                # as soon as it is ready, then the writer's tokens stream in.
+                status = st.empty()
+                details_placeholder = st.expander("🔍 Sources & Details", expanded=True).empty()
+                streamed_text = ""
+                started = time.monotonic()
+                for event in stream_pipeline(final_input, mode=mode, deadline=time_budget or None,
+                                             profile=profile_flag, cancel=cancel,
+                                             answered=st.session_state.session_data.get("answered_questions"),
+                                             memory=memory_block):
+                    kind = event["type"]
+                    if kind == "heartbeat":
+                        # quiet stretch (e.g. waiting for a first token): touching
+                        # the page lets Streamlit stop this script on rerun/disconnect
+                        ticker.caption(f"⏳ {time.monotonic() - started:.0f}s")
+                    elif kind == "question_started":
+                        status.caption(f"🔎 Researching {event['index']+1}/{event['total']}: {event['question']}")
+                    elif kind == "answer_ready":
+                        info = event["answer"]
+                        reused_note = " _(from earlier in this session)_" if event.get("reused") else ""
+                        detail_text += f"### {event['question']}{reused_note}\n{info.get('content','')}\n\n"
                         if info.get("sources"):
                             detail_text += "Sources:\n" + "\n".join(info["sources"]) + "\n\n"
+                        details_placeholder.markdown(detail_text)
+                    elif kind == "writer_started":
+                        status.caption("✍️ Writing report...")
+                    elif kind == "token":
+                        streamed_text += event["text"]
+                        placeholder.markdown(streamed_text + "▌")
+                    elif kind == "done":
+                        result = event["result"]
+                        remember_answers(st.session_state.session_data, result.get("answers"))
+                    elif kind == "error":
+                        raise event["error"]
+                    elif kind == "cancelled":
+                        raise Cancelled(event["reason"])
+                status.empty()
+                ticker.empty()
+                final_answer = result.get("final_text","") if result else "No response."
+                details_shown = True
             elif mode == "deep research":
-                merged = merged_research_and_web(final_input)
-                final_answer = writer_agent(final_input, merged)
+                def deep_research(query, cancel, memory):
+                    merged = merged_research_and_web(query, cancel=cancel, memory=memory)
+                    return merged, writer_agent(query, merged, mode="deep research", cancel=cancel, memory=memory)
+                merged, final_answer = run_cancellable(deep_research, final_input, cancel=cancel, ticker=ticker, memory=memory_block)
                 if merged.get("combined_sources"):
                     detail_text = "\n".join([f"- {s}" for s in merged["combined_sources"]])
             elif mode == "fast summary":
-                web = fast_summary_agent(final_input)
+                web = run_cancellable(fast_summary_agent, final_input, cancel=cancel, ticker=ticker, memory=memory_block)
                 final_answer = (web.get("content") or "No results found.")[:1500]
                 if web.get("sources"):
                     detail_text = "\n".join([f"- {s}" for s in web["sources"]])
             elif mode == "academic":
-                top = top5_research_papers(final_input)
+                top = run_cancellable(top5_research_papers, final_input, cancel=cancel, ticker=ticker, memory=memory_block)
                 papers = top.get("top_5") or []
                 final_answer = "\n".join([f"{i+1}. {p}" for i,p in enumerate(papers)]) if papers else "No papers found."
                 detail_text = "\n".join([f"- {p}" for p in papers])
             elif mode == "web search":
-                web = web_search_with_llm(final_input)
+                web = run_cancellable(web_search_with_llm, final_input, cancel=cancel, ticker=ticker, memory=memory_block)
                 final_answer = web.get("content","No web results found.")
                 if web.get("sources"):
                     detail_text = "\n".join([f"- {s}" for s in web["sources"]])
             elif mode == "research papers":
-                research = strict_research_agent(final_input)
+                research = run_cancellable(strict_research_agent, final_input, cancel=cancel, ticker=ticker, memory=memory_block)
                 final_answer = research.get("summary","No summary found.")
                 refs = research.get("references",[])
                 detail_text = "\n".join([f"- {r}" for r in refs])
             elif mode == "hybrid search":
-                merged = merged_research_and_web(final_input)
+                merged = run_cancellable(merged_research_and_web, final_input, cancel=cancel, ticker=ticker, memory=memory_block)
                 final_answer = merged.get("summary","No results.")
                 academic = merged.get("academic_papers",[])
                 web_links = merged.get("web_links",[])
                 detail_text = "\n".join([f"- {a}" for a in academic] + [f"- {w}" for w in web_links])
             else:
                 final_answer = "Mode not supported."
+        except Cancelled as c:
+            final_answer = f"⏹️ Research cancelled ({c.reason})."
         except Exception as e:
             final_answer = f"Error: {e}"
             detail_text = ""
-
-    typing_text = ""
-    for char in final_answer:
-        typing_text += char
-        placeholder.markdown(typing_text + "▌")
-        time.sleep(0.01)
+        finally:
+            if st.session_state.get("active_cancel") is cancel:
+                st.session_state.active_cancel = None
+
+    # Render the PDF in the background while the answer is shown and spoken
+    session_title = st.session_state.session_data.get("title", "session")
+    pdf_future = render_pdf_async(final_answer, session_title)
+
+    if not details_shown:
+        typing_text = ""
+        for char in final_answer:
+            typing_text += char
+            placeholder.markdown(typing_text + "▌")
+            time.sleep(0.01)
     placeholder.markdown(final_answer)
 
-    if detail_text:
+    if detail_text and not details_shown:
         with st.expander("🔍 Sources & Details"):
             st.markdown(detail_text)
 
@@ -492,19 +666,17 @@ if final_input:
     txt_bytes = final_answer.encode('utf-8')
     st.download_button("Download TXT (response)", txt_bytes, file_name=txt_name, mime="text/plain")
 
-    if mode=="deep research":
-        try:
-            pdf_name = writer_generate_pdf(final_answer, filename=f"{st.session_state.session_data.get('title','research')[:40].replace(' ','_')}.pdf")
-            with open(pdf_name,"rb") as pf:
-                st.download_button("Download Research PDF", pf, file_name=pdf_name)
-        except:
-            pdf_bytes = create_pdf(final_answer, st.session_state.session_data.get("title","session"))
-            st.download_button("Download PDF (response)", pdf_bytes, file_name=f"{st.session_state.session_data.get('title','session')}.pdf", mime="application/pdf")
-    else:
-        pdf_bytes = create_pdf(final_answer, st.session_state.session_data.get("title","session"))
-        st.download_button("Download PDF (response)", pdf_bytes, file_name=f"{st.session_state.session_data.get('title','session')}.pdf", mime="application/pdf")
+    try:
+        pdf_bytes = pdf_future.result()
+        if mode=="deep research":
+            st.download_button("Download Research PDF", pdf_bytes, file_name=f"{session_title[:40].replace(' ','_')}.pdf", mime="application/pdf")
+        else:
+            st.download_button("Download PDF (response)", pdf_bytes, file_name=f"{session_title}.pdf", mime="application/pdf")
+    except Exception as e:
+        st.warning(f"PDF export failed: {e}")
 
     st.session_state.session_data.setdefault("messages",[]).append({"role":"assistant","content":final_answer,"sources":detail_text})
+    conversation.update_async(st.session_state.session_data["messages"])
     st.session_state.stats["total"] +=1
     st.session_state.stats["today"] +=1
     st.session_state.stats["last"] = final_input
@@ -0,0 +1,39 @@
+# -------------------------------------------------
+# async_agents.py — Async-native agent API
+# -------------------------------------------------
+#
+# Coroutine versions of every agent, for an event loop or a FastAPI-style
+# service. They run on AsyncOpenAI / httpx.AsyncClient through the same
+# endpoint pool, rate limiters, hedge policy, prompt templates and budget
+# logic, so one process can keep hundreds of LLM and search calls in
+# flight without a thread per call.
+#
+#   answers = await asearcher_agent(plan["questions"])
+#   result  = await arun_pipeline("vector databases", deadline=60)
+#
+# Cancellation is asyncio-native: cancelling the awaiting task closes the
+# open HTTP streams and releases pool/limiter slots.
+#
+# The coroutines ARE the implementation; each lives next to its sync
+# wrapper (which runs it on the shared loop, see event_loop.py). This
+# module only gathers them in one place.
+
+from Planner import aplanner_agent
+from research_assistant import (
+    aweb_search, asearcher_agent, astrict_research_agent, atop5_research_papers, amerged_research_and_web,
+)
+from writer import awriter_agent
+from llm_router import agenerate_response
+from pipeline import arun_pipeline
+
+__all__ = [
+    "aplanner_agent",
+    "aweb_search",
+    "asearcher_agent",
+    "awriter_agent",
+    "astrict_research_agent",
+    "atop5_research_papers",
+    "amerged_research_and_web",
+    "agenerate_response",
+    "arun_pipeline",
+]
@@ -0,0 +1,71 @@
+# -------------------------------------------------
+# budget.py — Latency budget shared by planner, searcher and writer
+# -------------------------------------------------
+
+import time
+import threading
+from typing import Dict, List, Optional
+
+# Per-stage duration estimates (seconds), refined with an EWMA of real runs
+_estimates = {
+    "searcher": 20.0,   # one searcher LLM call
+    "writer": 60.0,     # full 12-section report
+}
+_ALPHA = 0.3
+_lock = threading.Lock()
+
+# Smallest share of a full searcher call worth starting (as a truncated
+# answer) instead of skipping the question
+MIN_TRUNCATED_FRACTION = 0.4
+
+
+def estimate(stage: str) -> float:
+    with _lock:
+        return _estimates[stage]
+
+
+def observe(stage: str, seconds: float):
+    with _lock:
+        _estimates[stage] = _ALPHA * seconds + (1 - _ALPHA) * _estimates[stage]
+
+
+class Budget:
+    """
+    Wall-clock deadline for one research run. Stages ask how much time is
+    left and record what they had to skip or cut short.
+    """
+
+    def __init__(self, seconds: Optional[float] = None):
+        self.seconds = seconds
+        self.deadline = None if seconds is None else time.monotonic() + seconds
+        self.skipped: List[Dict] = []
+
+    @classmethod
+    def coerce(cls, value) -> "Budget":
+        if isinstance(value, Budget):
+            return value
+        return cls(value)
+
+    @property
+    def unlimited(self) -> bool:
+        return self.deadline is None
+
+    def remaining(self) -> float:
+        if self.deadline is None:
+            return float("inf")
+        return max(0.0, self.deadline - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def skip(self, stage: str, item: str, reason: str):
+        self.skipped.append({"stage": stage, "item": item, "reason": reason})
+
+    def summary(self) -> str:
+        """Human-readable note for the response, empty if nothing was skipped."""
+        if not self.skipped:
+            return ""
+        lines = [f"⚠️ Partial result to fit the {self.seconds:.0f}s time budget:"]
+        for s in self.skipped:
+            lines.append(f"- [{s['stage']}] {s['item']} ({s['reason']})")
+        return "\n".join(lines)
@@ -0,0 +1,119 @@
+# -------------------------------------------------
+# conversation_memory.py — Bounded rolling memory for follow-up queries
+# -------------------------------------------------
+#
+# The last few messages are kept verbatim; everything older is folded
+# into a running summary by the local model on a background thread.
+# context_block() always fits in a fixed token budget, so follow-ups stay
+# context-aware without the prompt growing with the conversation.
+#
+# State is a plain dict stored in the session JSON ("memory"):
+#   {"summary": str, "folded": <number of messages already in the summary>}
+# Messages that aged out of the verbatim window but are not folded yet
+# (summary still running, or the app restarted) are covered by a cheap
+# extractive fallback, so nothing drops out of the context in between.
+
+import threading
+from typing import Dict, List
+
+from llm_pool import generate
+from prompts import build as build_prompt
+
+RECENT_MESSAGES = 4          # verbatim window (2 exchanges)
+SUMMARY_TOKENS = 250
+RECENT_TOKENS = 350          # shared by the verbatim messages
+FOLD_INPUT_CHARS = 1200      # per message sent to the summarizer
+FOLD_BATCH = 6               # messages per summarizer call
+CHARS_PER_TOKEN = 4
+
+
+def _clip(text: str, tokens: int) -> str:
+    limit = tokens * CHARS_PER_TOKEN
+    text = " ".join((text or "").split())
+    return text if len(text) <= limit else text[:limit - 3].rstrip() + "..."
+
+
+def _clip_tail(text: str, tokens: int) -> str:
+    """Keeps the most recent part of a summary."""
+    limit = tokens * CHARS_PER_TOKEN
+    return text if len(text) <= limit else "..." + text[-(limit - 3):].lstrip()
+
+
+def _extractive(messages: List[Dict]) -> str:
+    """No-LLM summary: what the user asked, in order."""
+    asked = [_clip(m.get("content", ""), 30) for m in messages if m.get("role") == "user"]
+    return "; ".join(f"User asked: {q}" for q in asked if q)
+
+
+class ConversationMemory:
+    def __init__(self, state: Dict, recent_messages: int = RECENT_MESSAGES,
+                 summary_tokens: int = SUMMARY_TOKENS, recent_tokens: int = RECENT_TOKENS):
+        self.state = state
+        self.state.setdefault("summary", "")
+        self.state.setdefault("folded", 0)
+        self.recent_messages = recent_messages
+        self.summary_tokens = summary_tokens
+        self.recent_tokens = recent_tokens
+        self._lock = threading.Lock()
+        self._worker = None
+
+    # ---------------------------
+    # Context for the agents
+    # ---------------------------
+    def context_block(self, messages: List[Dict]) -> str:
+        """
+        Fixed-size context for the next query. `messages` is the history
+        BEFORE the current user message.
+        """
+        cut = max(0, len(messages) - self.recent_messages)
+        with self._lock:
+            summary, folded = self.state["summary"], self.state["folded"]
+
+        pending = _extractive(messages[folded:cut]) if folded < cut else ""
+        summary = _clip_tail(" ".join(s for s in (summary, pending) if s), self.summary_tokens)
+
+        recent = messages[cut:]
+        per_message = self.recent_tokens // max(1, len(recent))
+        lines = [f"{m.get('role', 'user').title()}: {_clip(m.get('content', ''), per_message)}" for m in recent]
+
+        parts = []
+        if summary:
+            parts.append(f"Earlier in this conversation: {summary}")
+        if lines:
+            parts.append("Most recent messages:\n" + "\n".join(lines))
+        return "\n\n".join(parts)
+
+    # ---------------------------
+    # Background summarization
+    # ---------------------------
+    def update_async(self, messages: List[Dict]):
+        """Folds messages that left the verbatim window into the summary."""
+        cut = max(0, len(messages) - self.recent_messages)
+        if cut - self.state["folded"] < 2 or (self._worker is not None and self._worker.is_alive()):
+            return
+        start = self.state["folded"]
+        snapshot = list(messages[start:cut])
+        self._worker = threading.Thread(target=self._fold_all, args=(snapshot, start), daemon=True, name="memory-fold")
+        self._worker.start()
+
+    def _fold_all(self, aged_out: List[Dict], start: int):
+        # bounded batches: a long restored session never means one huge prompt
+        for i in range(0, len(aged_out), FOLD_BATCH):
+            batch = aged_out[i:i + FOLD_BATCH]
+            self._fold(batch, start + i + len(batch))
+
+    def _fold(self, aged_out: List[Dict], upto: int):
+        turns = "\n".join(
+            f"{m.get('role', 'user').title()}: {_clip(m.get('content', ''), FOLD_INPUT_CHARS // CHARS_PER_TOKEN)}"
+            for m in aged_out
+        )
+        try:
+            summary = generate(
+                build_prompt("memory_summary", summary=self.state["summary"] or "(empty)", turns=turns),
+                max_tokens=self.summary_tokens + 50
+            ).strip()
+        except Exception:
+            summary = " ".join(s for s in (self.state["summary"], _extractive(aged_out)) if s)
+        with self._lock:
+            self.state["summary"] = _clip_tail(summary, self.summary_tokens)
+            self.state["folded"] = upto
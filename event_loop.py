@@ -0,0 +1,215 @@
+# -------------------------------------------------
+# event_loop.py — One background event loop behind the sync API
+# -------------------------------------------------
+#
+# Every agent is implemented once, as a coroutine. Sync callers (Streamlit
+# script and worker threads, the batch CLI, the memory summarizer) go
+# through run_sync(), which runs the coroutine on ONE shared loop thread
+# and blocks for its result. A CancelToken cancels the task: its HTTP
+# streams are closed and pool/limiter slots released on the way out.
+# Inside a profile_run() the coroutine runs on the calling thread instead
+# (its own loop), so cProfile sees the agent code.
+#
+# AsyncOpenAI / httpx.AsyncClient are bound to the loop that created them,
+# so shared clients are kept PerLoop; coroutine callers on their own loop
+# (asyncio.run, FastAPI) get their own clients.
+#
+# Waiters is the FIFO handoff queue behind the endpoint pool and the
+# concurrency limiters: a freed slot goes straight to the longest waiter,
+# from any thread or loop, without polling.
+
+import asyncio
+import threading
+import contextvars
+import weakref
+import concurrent.futures
+from collections import deque
+from typing import Callable, Optional
+
+from cancellation import CancelToken, Cancelled
+from profiling import profiling_this_thread
+
+_loop = None
+_loop_lock = threading.Lock()
+_current_cancel: "contextvars.ContextVar[Optional[CancelToken]]" = contextvars.ContextVar("cancel", default=None)
+
+
+# ===============================================================
+# SHARED LOOP
+# ===============================================================
+def get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True, name="agents-loop").start()
+        return _loop
+
+
+async def _with_token(coro, cancel: CancelToken):
+    _current_cancel.set(cancel)
+    return await coro
+
+
+def run_sync(coro, cancel: CancelToken = None):
+    """
+    Runs `coro` on the shared loop and returns its result. Raises
+    Cancelled once `cancel` fires (the task is cancelled, not abandoned).
+    """
+    loop = get_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        coro.close()
+        raise RuntimeError("run_sync() called on the agents loop; await the coroutine instead")
+    if cancel is not None and cancel.cancelled:
+        coro.close()
+        raise Cancelled(cancel.reason)
+    if running is None and profiling_this_thread():
+        return _run_here(coro, cancel)
+
+    future = asyncio.run_coroutine_threadsafe(_with_token(coro, cancel), loop)
+    if cancel is not None:
+        cancel.register(future.cancel)
+    try:
+        return future.result()
+    except concurrent.futures.CancelledError:
+        if cancel is not None and cancel.cancelled:
+            raise Cancelled(cancel.reason) from None
+        raise
+    except BaseException:
+        # the waiting thread itself was interrupted: do not leave the task running
+        future.cancel()
+        raise
+    finally:
+        if cancel is not None:
+            cancel.unregister(future.cancel)
+
+
+def _run_here(coro, cancel: CancelToken = None):
+    """run_sync() on a private loop in the calling thread (profiled runs)."""
+    async def main():
+        loop, task = asyncio.get_running_loop(), asyncio.current_task()
+
+        def closer():
+            loop.call_soon_threadsafe(task.cancel)
+
+        if cancel is not None:
+            cancel.register(closer)
+        try:
+            return await _with_token(coro, cancel)
+        finally:
+            if cancel is not None:
+                cancel.unregister(closer)
+
+    try:
+        return asyncio.run(main())
+    except asyncio.CancelledError:
+        if cancel is not None and cancel.cancelled:
+            raise Cancelled(cancel.reason) from None
+        raise
+
+
+def cancel_requested() -> bool:
+    """True when the CancelToken of the run_sync() call driving this task fired."""
+    token = _current_cancel.get()
+    return token is not None and token.cancelled
+
+
+# ===============================================================
+# PER-LOOP OBJECTS
+# ===============================================================
+class PerLoop:
+    """One object per running event loop, built on first use by factory()."""
+
+    def __init__(self, factory: Callable):
+        self.factory = factory
+        self._objects = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def get(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop not in self._objects:
+                self._objects[loop] = self.factory()
+            return self._objects[loop]
+
+
+# ===============================================================
+# FIFO WAITERS
+# ===============================================================
+class _Entry:
+    __slots__ = ("loop", "future", "data")
+
+    def __init__(self, data):
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+        self.data = data
+
+
+class Waiters:
+    """
+    Arrival-ordered queue of coroutines waiting for a slot. The owner calls
+    every method under its own lock and grants slots with grant(); a slot
+    granted to a waiter that gave up in the meantime goes to give_back().
+    """
+
+    def __init__(self, give_back: Callable):
+        self.give_back = give_back
+        self._queue = deque()
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def __iter__(self):
+        return iter(list(self._queue))
+
+    def enqueue(self, data=None) -> _Entry:
+        entry = _Entry(data)
+        self._queue.append(entry)
+        return entry
+
+    def grant(self, entry: _Entry, value) -> bool:
+        """Hands `value` to the waiter; False if its loop is gone (entry dropped)."""
+        self._queue.remove(entry)
+        try:
+            entry.loop.call_soon_threadsafe(self._deliver, entry.future, value)
+            return True
+        except RuntimeError:
+            return False
+
+    def fail(self, entry: _Entry, error: BaseException):
+        self._queue.remove(entry)
+        try:
+            entry.loop.call_soon_threadsafe(self._fail, entry.future, error)
+        except RuntimeError:
+            pass
+
+    def withdraw(self, entry: _Entry):
+        """
+        The waiter stopped waiting (timeout, cancellation). Returns a value
+        it was granted meanwhile, which the caller must give back.
+        """
+        if entry in self._queue:
+            self._queue.remove(entry)
+            return None
+        future = entry.future
+        if not future.done():
+            future.cancel()          # grant still in flight: _deliver gives it back
+            return None
+        if future.cancelled() or future.exception() is not None:
+            return None
+        return future.result()
+
+    def _deliver(self, future: asyncio.Future, value):
+        if future.done():
+            self.give_back(value)
+        else:
+            future.set_result(value)
+
+    @staticmethod
+    def _fail(future: asyncio.Future, error: BaseException):
+        if not future.done():
+            future.set_exception(error)
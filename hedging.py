@@ -0,0 +1,324 @@
+# -------------------------------------------------
+# hedging.py — Hedged requests between local pool and OpenAI
+# -------------------------------------------------
+#
+# The local pool is always tried first. If it has not produced a first
+# token within the learned p95 time-to-first-token for the mode, a hedge
+# request is fired at OpenAI and whichever backend streams first wins;
+# the loser's HTTP stream is closed. A sliding-window cap keeps the share
+# of hedged calls (i.e. extra OpenAI spend) bounded.
+#
+# The race runs on asyncio tasks; hedged_completion() is the sync wrapper.
+#
+# Environment:
+#   HEDGE_ENABLED    "0" disables hedging (plain fallback-on-error remains)
+#   HEDGE_MAX_RATE   max fraction of recent calls allowed to hedge (0.1)
+#   OPENAI_API_KEY   secondary backend; without it no hedge is ever fired
+
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+from typing import Callable, Dict, Optional, Tuple
+
+from openai import AsyncOpenAI
+from dotenv import load_dotenv
+
+from llm_pool import get_pool, DEFAULT_MODEL, TruncatedCompletion
+from recorder import async_http_client
+from rate_limit import limiter, estimate_tokens
+from cancellation import CancelToken, count as count_metric
+from event_loop import run_sync, PerLoop
+
+load_dotenv()
+
+OPENAI_MODEL = "gpt-4o-mini"
+
+# Per-mode hedge deadline budget: (floor, ceiling, initial) in seconds.
+# The learned p95 is clamped into [floor, ceiling]; "initial" is used
+# until enough samples exist. Keys are the UI modes that reach the writer
+# (the other modes make a single non-hedged call), plus "factual" for
+# short direct answers.
+MODE_BUDGETS = {
+    "factual": (1.5, 8.0, 4.0),
+    "normal": (3.0, 20.0, 10.0),
+    "code": (3.0, 20.0, 10.0),
+    "deep research": (5.0, 45.0, 20.0),
+}
+_DEFAULT_BUDGET = MODE_BUDGETS["normal"]
+_MIN_SAMPLES = 20
+# The hedge cap is a rate over the calls actually seen, but never over
+# fewer than this many (so a fresh process cannot hedge every call)
+_MIN_RATE_CALLS = 20
+
+
+# ===============================================================
+# LATENCY TRACKER (time-to-first-token)
+# ===============================================================
+class LatencyTracker:
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples: Dict[Tuple[str, str], deque] = {}
+        self._lock = threading.Lock()
+
+    def record(self, backend: str, mode: str, seconds: float):
+        with self._lock:
+            key = (backend, mode)
+            if key not in self._samples:
+                self._samples[key] = deque(maxlen=self.window)
+            self._samples[key].append(seconds)
+
+    def percentile(self, backend: str, mode: str, pct: float = 0.95) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples.get((backend, mode), ()))
+        if len(samples) < _MIN_SAMPLES:
+            return None
+        idx = min(len(samples) - 1, int(round(pct * (len(samples) - 1))))
+        return samples[idx]
+
+
+# ===============================================================
+# HEDGE POLICY
+# ===============================================================
+class HedgePolicy:
+    def __init__(self, max_rate: float = 0.1, window: int = 100, enabled: bool = True):
+        self.max_rate = max_rate
+        self.enabled = enabled
+        self.tracker = LatencyTracker()
+        self._recent = deque(maxlen=window)   # True = call was hedged
+        self._lock = threading.Lock()
+        self.counters = {"calls": 0, "hedged": 0, "hedge_denied": 0,
+                         "primary_wins": 0, "secondary_wins": 0, "failovers": 0}
+
+    def deadline(self, mode: str) -> float:
+        floor, ceiling, initial = MODE_BUDGETS.get(mode, _DEFAULT_BUDGET)
+        p95 = self.tracker.percentile("local", mode)
+        if p95 is None:
+            return initial
+        return min(ceiling, max(floor, p95))
+
+    def start_call(self):
+        with self._lock:
+            self.counters["calls"] += 1
+            self._recent.append(False)
+
+    def allow_hedge(self) -> bool:
+        with self._lock:
+            hedged = sum(self._recent)
+            if not self.enabled or (hedged + 1) > self.max_rate * max(len(self._recent), _MIN_RATE_CALLS):
+                self.counters["hedge_denied"] += 1
+                return False
+            self._recent[-1] = True
+            self.counters["hedged"] += 1
+            return True
+
+    def count(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            recent = len(self._recent)
+            return dict(self.counters, recent_hedge_rate=(sum(self._recent) / recent) if recent else 0.0)
+
+
+policy = HedgePolicy(
+    max_rate=float(os.getenv("HEDGE_MAX_RATE", "0.1")),
+    enabled=os.getenv("HEDGE_ENABLED", "1") != "0"
+)
+
+_openai_clients = PerLoop(
+    lambda: AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=async_http_client())
+    if os.getenv("OPENAI_API_KEY") else None
+)
+
+
+def get_openai_client() -> Optional[AsyncOpenAI]:
+    """OpenAI client for the running event loop; None without OPENAI_API_KEY."""
+    return _openai_clients.get()
+
+
+# ===============================================================
+# BACKEND STREAMS
+# ===============================================================
+async def local_stream(messages: list, **kwargs):
+    async for token in get_pool().astream_chat(messages, model=DEFAULT_MODEL, **kwargs):
+        yield token
+
+
+async def openai_stream(messages: list, **kwargs):
+    client = get_openai_client()
+    async with limiter("openai").aslot(estimate_tokens(messages, kwargs.get("max_tokens"))):
+        stream = await client.chat.completions.create(
+            model=OPENAI_MODEL, messages=messages, stream=True, **kwargs
+        )
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except (GeneratorExit, asyncio.CancelledError):
+            count_metric("streams_closed")
+            raise
+        finally:
+            await stream.close()
+
+
+# ===============================================================
+# RACE
+# ===============================================================
+class _Racer:
+    def __init__(self, name: str):
+        self.backend = name
+        self.started_at = time.monotonic()
+        self.first_token_at = None
+        self.parts = []
+        self.error = None
+        self.done = False
+        self.finished_at = None
+        self.task = None
+
+
+async def ahedged_completion(
+    messages: list,
+    mode: str = "normal",
+    on_token: Optional[Callable[[str], None]] = None,
+    primary: Callable = local_stream,
+    secondary: Callable = openai_stream,
+    **kwargs
+) -> Tuple[str, str]:
+    """
+    Returns (text, backend) where backend is "LM Studio" or "OpenAI".
+    Falls over to the secondary immediately if the primary errors before
+    producing a token, and raises the last error if every backend failed.
+    A winner that fails mid-stream raises TruncatedCompletion, as does one
+    still streaming when `timeout` (a wall-clock limit for the whole race,
+    also passed to the clients) runs out; its stream is closed.
+    The loser's task is cancelled, which closes its HTTP stream;
+    cancelling the caller cancels both.
+    """
+    has_secondary = secondary is not openai_stream or get_openai_client() is not None
+    policy.start_call()
+    progress = asyncio.Event()
+    race = {"winner": None}
+    racers = []
+    timeout = kwargs.get("timeout")
+    ends = None if timeout is None else time.monotonic() + timeout
+
+    def left() -> Optional[float]:
+        return None if ends is None else max(0.0, ends - time.monotonic())
+
+    async def run(racer: _Racer, stream_fn: Callable):
+        try:
+            async for token in stream_fn(messages, **kwargs):
+                if racer.first_token_at is None:
+                    racer.first_token_at = time.monotonic()
+                    if race["winner"] is None:
+                        race["winner"] = racer
+                        for other in racers:
+                            if other is not racer:
+                                other.task.cancel()
+                        progress.set()
+                    if race["winner"] is not racer:
+                        return
+                racer.parts.append(token)
+                if on_token is not None:
+                    on_token(token)
+        except Exception as e:
+            racer.error = e
+        finally:
+            racer.done = True
+            racer.finished_at = time.monotonic()
+            progress.set()
+
+    def launch(name: str, stream_fn: Callable) -> _Racer:
+        racer = _Racer(name)
+        racers.append(racer)
+        racer.task = asyncio.ensure_future(run(racer, stream_fn))
+        return racer
+
+    async def until(predicate, timeout: float = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not predicate():
+            progress.clear()
+            left = None if deadline is None else deadline - time.monotonic()
+            if left is not None and left <= 0:
+                return
+            try:
+                await asyncio.wait_for(progress.wait(), left)
+            except asyncio.TimeoutError:
+                return
+
+    winner, expired = None, None
+    try:
+        local = launch("local", primary)
+
+        # Phase 1: give the primary its p95 budget to produce a first token
+        first_token_budget = policy.deadline(mode) if ends is None else min(policy.deadline(mode), left())
+        await until(lambda: race["winner"] is not None or local.done, first_token_budget)
+
+        if race["winner"] is None and has_secondary and left() != 0:
+            if local.done:
+                policy.count("failovers")
+                launch("openai", secondary)
+            elif policy.allow_hedge():
+                launch("openai", secondary)
+
+        # Phase 2: wait for a winner, or for every launched racer to fail
+        await until(lambda: race["winner"] is not None or all(r.done for r in racers), left())
+        winner = race["winner"]
+        if winner is not None:
+            await until(lambda: winner.done, left())
+        if not (winner.done if winner is not None else all(r.done for r in racers)):
+            expired = TimeoutError(f"{timeout:.1f}s wall-clock deadline reached")
+    finally:
+        # closes the stream of every racer still running (loser or deadline)
+        for racer in racers:
+            if not racer.done:
+                racer.task.cancel()
+
+    return _race_result(winner, local, racers, mode, expired)
+
+
+def _race_result(winner, local, racers: list, mode: str, expired: BaseException = None) -> Tuple[str, str]:
+    """Records the primary's TTFT sample and turns the race into (text, backend)."""
+    if winner is None:
+        if expired is not None:
+            raise expired
+        errors = [r.error for r in racers if r.error is not None]
+        if errors:
+            raise errors[-1]
+        return "", "LM Studio"
+
+    if winner.backend == "local":
+        policy.tracker.record("local", mode, winner.first_token_at - winner.started_at)
+        policy.count("primary_wins")
+    else:
+        # censored sample: the primary was at least this slow — but only if
+        # it was still waiting (a failover's time-to-failure is not a TTFT)
+        if local.finished_at is None or local.finished_at > winner.first_token_at:
+            policy.tracker.record("local", mode, winner.first_token_at - local.started_at)
+        policy.count("secondary_wins")
+
+    backend = "LM Studio" if winner.backend == "local" else "OpenAI"
+    if expired is not None:
+        raise TruncatedCompletion("".join(winner.parts), backend, expired) from expired
+    if winner.error is not None:
+        if not winner.parts:
+            raise winner.error
+        raise TruncatedCompletion("".join(winner.parts), backend, winner.error) from winner.error
+    return "".join(winner.parts), backend
+
+
+def hedged_completion(
+    messages: list,
+    mode: str = "normal",
+    on_token: Optional[Callable[[str], None]] = None,
+    cancel: CancelToken = None,
+    **kwargs
+) -> Tuple[str, str]:
+    """
+    Sync ahedged_completion(); on_token is called from the agents loop
+    thread. Raises Cancelled (after closing every stream) if `cancel` fires.
+    """
+    return run_sync(ahedged_completion(messages, mode=mode, on_token=on_token, **kwargs), cancel=cancel)
@@ -0,0 +1,408 @@
+# -------------------------------------------------
+# llm_pool.py — Load-balanced pool of OpenAI-compatible LLM endpoints
+# -------------------------------------------------
+#
+# Every agent talks to the local model through ONE shared pool, so adding
+# another LM Studio / llama.cpp box is a config change, not a code change.
+# The pool is async (achat / astream_chat / agenerate on AsyncOpenAI);
+# chat_completion() and generate() are the sync wrappers (event_loop.py).
+#
+# Environment:
+#   LLM_ENDPOINTS           comma separated base URLs, optional "|<cap>" suffix
+#                           e.g. "http://localhost:1234/v1|2,http://10.205.85.250:1234/v1|4"
+#   LLM_ENDPOINT_CONCURRENCY  default per-endpoint concurrency cap (2)
+#   LLM_BALANCE             "least_outstanding" (default) or "latency"
+#   LLM_MODEL_MAP           JSON {base_url: {requested_model: served_model}}
+#                           ("*" maps every model name for that endpoint)
+
+import os
+import json
+import time
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+from openai import AsyncOpenAI, APIConnectionError, APITimeoutError, InternalServerError
+from dotenv import load_dotenv
+
+from recorder import async_http_client
+from rate_limit import limiter, estimate_tokens, prompt_tokens
+from cancellation import CancelToken, count as count_metric
+from event_loop import run_sync, PerLoop, Waiters, cancel_requested
+from prompts import record_call
+
+load_dotenv()
+
+DEFAULT_ENDPOINTS = "http://localhost:1234/v1"
+DEFAULT_MODEL = "qwen2.5-7b-instruct-1m-q4"
+DEFAULT_TIMEOUT = 180
+
+# Errors that say "this box is unhealthy" (vs. a bad request)
+_HEALTH_ERRORS = (APIConnectionError, APITimeoutError, InternalServerError)
+
+
+class NoHealthyEndpoint(RuntimeError):
+    pass
+
+
+class TruncatedCompletion(RuntimeError):
+    """
+    A streamed answer stopped early: the stream failed mid-answer or its
+    wall-clock deadline passed. `text` holds what arrived before; the
+    cause is chained.
+    """
+
+    def __init__(self, text: str, backend: str, error: BaseException):
+        super().__init__(f"{backend} stream stopped after {len(text)} chars: {error}")
+        self.text = text
+        self.backend = backend
+
+
+# ===============================================================
+# ENDPOINT
+# ===============================================================
+class Endpoint:
+    def __init__(
+        self,
+        base_url: str,
+        max_concurrency: int = 2,
+        model_map: Optional[Dict[str, str]] = None,
+        api_key: str = "lm-studio",
+        timeout: float = DEFAULT_TIMEOUT
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.model_map = model_map or {}
+        self.api_key = api_key
+        self.timeout = timeout
+        self._clients = PerLoop(lambda: AsyncOpenAI(
+            base_url=self.base_url,
+            api_key=self.api_key,
+            timeout=self.timeout,
+            http_client=async_http_client(self.timeout)
+        ))
+
+        self.outstanding = 0
+        self.ewma_latency = 1.0      # seconds, optimistic start
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.total_requests = 0
+        self.total_errors = 0
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        """Client for the running event loop (created on first use there)."""
+        return self._clients.get()
+
+    def resolve_model(self, model: str) -> str:
+        return self.model_map.get(model, self.model_map.get("*", model))
+
+    def is_healthy(self, now: float = None) -> bool:
+        return (now or time.monotonic()) >= self.ejected_until
+
+    def has_capacity(self) -> bool:
+        return self.outstanding < self.max_concurrency
+
+    def load_score(self, strategy: str) -> float:
+        if strategy == "latency":
+            return self.ewma_latency * (self.outstanding + 1)
+        return self.outstanding / self.max_concurrency
+
+    def snapshot(self) -> Dict:
+        return {
+            "base_url": self.base_url,
+            "outstanding": self.outstanding,
+            "max_concurrency": self.max_concurrency,
+            "ewma_latency": round(self.ewma_latency, 3),
+            "healthy": self.is_healthy(),
+            "total_requests": self.total_requests,
+            "total_errors": self.total_errors,
+        }
+
+
+# ===============================================================
+# POOL
+# ===============================================================
+class EndpointPool:
+    def __init__(
+        self,
+        endpoints: List[Endpoint],
+        strategy: str = "least_outstanding",
+        eject_after: int = 3,
+        eject_seconds: float = 30.0,
+        ewma_alpha: float = 0.3
+    ):
+        if not endpoints:
+            raise ValueError("EndpointPool needs at least one endpoint")
+        self.endpoints = endpoints
+        self.strategy = strategy
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.ewma_alpha = ewma_alpha
+        self._lock = threading.Lock()
+        self._waiters = Waiters(give_back=self.release)
+
+    # ---------------------------
+    # Lease management
+    # ---------------------------
+    def _pick(self, exclude) -> Optional[Endpoint]:
+        now = time.monotonic()
+        candidates = [
+            ep for ep in self.endpoints
+            if ep not in exclude and ep.is_healthy(now) and ep.has_capacity()
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda ep: ep.load_score(self.strategy))
+
+    def _usable(self, exclude) -> bool:
+        now = time.monotonic()
+        return any(ep not in exclude and ep.is_healthy(now) for ep in self.endpoints)
+
+    @staticmethod
+    def _take(ep: Endpoint):
+        ep.outstanding += 1
+        ep.total_requests += 1
+
+    async def acquire(self, timeout: float = None, exclude=()) -> Endpoint:
+        """
+        Waits until an endpoint with free capacity is available; a freed
+        slot is handed to the longest-waiting caller that can use it.
+        Raises NoHealthyEndpoint when every endpoint is ejected/excluded.
+        """
+        with self._lock:
+            ep = self._pick(exclude)
+            if ep is not None:
+                self._take(ep)
+                return ep
+            if not self._usable(exclude):
+                raise NoHealthyEndpoint("No healthy LLM endpoint available")
+            entry = self._waiters.enqueue(exclude)
+        try:
+            return await asyncio.wait_for(entry.future, timeout)
+        except BaseException as e:
+            with self._lock:
+                granted = self._waiters.withdraw(entry)
+            if granted is not None:
+                self.release(granted)
+            if isinstance(e, asyncio.TimeoutError):
+                raise NoHealthyEndpoint("Timed out waiting for LLM endpoint capacity") from None
+            raise
+
+    def _grant(self):
+        for entry in self._waiters:
+            ep = self._pick(entry.data)
+            if ep is not None:
+                if self._waiters.grant(entry, ep):
+                    self._take(ep)
+            elif not self._usable(entry.data):
+                self._waiters.fail(entry, NoHealthyEndpoint("No healthy LLM endpoint available"))
+
+    def release(self, ep: Endpoint, latency: float = None, error: BaseException = None):
+        with self._lock:
+            ep.outstanding = max(0, ep.outstanding - 1)
+            if error is not None:
+                ep.total_errors += 1
+                if isinstance(error, _HEALTH_ERRORS):
+                    ep.consecutive_failures += 1
+                    if ep.consecutive_failures >= self.eject_after:
+                        ep.ejected_until = time.monotonic() + self.eject_seconds
+                        # half-open: allow one probe after cooldown
+                        ep.consecutive_failures = self.eject_after - 1
+            elif latency is not None:
+                ep.consecutive_failures = 0
+                a = self.ewma_alpha
+                ep.ewma_latency = a * latency + (1 - a) * ep.ewma_latency
+            self._grant()
+
+    @asynccontextmanager
+    async def lease(self, timeout: float = None, exclude=()):
+        ep = await self.acquire(timeout=timeout, exclude=exclude)
+        start = time.monotonic()
+        try:
+            yield ep
+        except (GeneratorExit, asyncio.CancelledError):
+            # stream closed / task cancelled by the caller — not an endpoint failure
+            self.release(ep)
+            raise
+        except BaseException as e:
+            self.release(ep, error=e)
+            raise
+        else:
+            self.release(ep, latency=time.monotonic() - start)
+
+    # ---------------------------
+    # Chat helpers
+    # ---------------------------
+    async def achat(self, messages: list, model: str = DEFAULT_MODEL, **kwargs):
+        """
+        Drop-in for client.chat.completions.create(); fails over to the
+        next endpoint on connection/timeout/5xx errors.
+        """
+        tried, last_error = [], None
+        while True:
+            try:
+                async with limiter("lmstudio").aslot(estimate_tokens(messages, kwargs.get("max_tokens"))) as ticket, \
+                        self.lease(exclude=tried) as ep:
+                    if cancel_requested():
+                        # token fired while queued: don't start a request nobody awaits
+                        raise asyncio.CancelledError()
+                    # AIMD latency excludes the wait for pool capacity
+                    ticket.start_clock()
+                    tried.append(ep)
+                    response = await ep.client.chat.completions.create(
+                        model=ep.resolve_model(model),
+                        messages=messages,
+                        **kwargs
+                    )
+                    usage = getattr(response, "usage", None)
+                    if usage is not None:
+                        ticket.set_tokens(usage.total_tokens)
+                    record_call(messages, ep.base_url, usage=usage)
+                    return response
+            except _HEALTH_ERRORS as e:
+                last_error = e
+                if len(tried) >= len(self.endpoints):
+                    raise
+            except NoHealthyEndpoint:
+                if last_error is not None:
+                    raise last_error
+                raise
+
+    async def astream_chat(self, messages: list, model: str = DEFAULT_MODEL, **kwargs):
+        """
+        Async generator of content deltas. The endpoint lease is held until
+        the stream is exhausted or closed, so concurrency caps stay honest;
+        cancelling the task (or aclose()) aborts the HTTP response, and
+        the wait for a lease. A run_sync() CancelToken that fired while the
+        caller was queued is honoured before the request is sent.
+        """
+        async with limiter("lmstudio").aslot(estimate_tokens(messages, kwargs.get("max_tokens"))) as ticket, \
+                self.lease() as ep:
+            if cancel_requested():
+                raise asyncio.CancelledError()
+            ticket.start_clock()
+            started = time.monotonic()
+            stream = await ep.client.chat.completions.create(
+                model=ep.resolve_model(model),
+                messages=messages,
+                stream=True,
+                **kwargs
+            )
+            generated = 0
+            try:
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if not generated:
+                            record_call(messages, ep.base_url, ttft=time.monotonic() - started)
+                        generated += 1
+                        yield chunk.choices[0].delta.content
+            except (GeneratorExit, asyncio.CancelledError):
+                count_metric("streams_closed")
+                raise
+            finally:
+                ticket.set_tokens(prompt_tokens(messages) + generated)
+                await stream.close()
+
+    def is_available(self) -> bool:
+        now = time.monotonic()
+        return any(ep.is_healthy(now) for ep in self.endpoints)
+
+    def capacity(self) -> int:
+        """How many requests the healthy endpoints serve at once (at least 1)."""
+        now = time.monotonic()
+        return max(1, sum(ep.max_concurrency for ep in self.endpoints if ep.is_healthy(now)))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "strategy": self.strategy,
+                "endpoints": [ep.snapshot() for ep in self.endpoints],
+            }
+
+
+# ===============================================================
+# DEFAULT POOL (built from environment)
+# ===============================================================
+def _parse_endpoints(spec: str, default_cap: int, model_map: Dict) -> List[Endpoint]:
+    endpoints = []
+    for item in (spec or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        url, _, cap = item.partition("|")
+        url = url.strip().rstrip("/")
+        endpoints.append(Endpoint(
+            url,
+            max_concurrency=int(cap) if cap.strip().isdigit() else default_cap,
+            model_map=model_map.get(url, {})
+        ))
+    return endpoints
+
+
+def build_pool_from_env() -> EndpointPool:
+    try:
+        model_map = json.loads(os.getenv("LLM_MODEL_MAP", "") or "{}")
+    except ValueError:
+        model_map = {}
+    model_map = {k.rstrip("/"): v for k, v in model_map.items()}
+
+    endpoints = _parse_endpoints(
+        os.getenv("LLM_ENDPOINTS", DEFAULT_ENDPOINTS),
+        int(os.getenv("LLM_ENDPOINT_CONCURRENCY", "2")),
+        model_map
+    ) or _parse_endpoints(DEFAULT_ENDPOINTS, 2, model_map)
+
+    return EndpointPool(endpoints, strategy=os.getenv("LLM_BALANCE", "least_outstanding"))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> EndpointPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = build_pool_from_env()
+    return _pool
+
+
+async def achat_completion(messages: list, model: str = DEFAULT_MODEL, **kwargs):
+    return await get_pool().achat(messages, model=model, **kwargs)
+
+
+async def agenerate(messages: list, model: str = DEFAULT_MODEL, timeout: float = None, **kwargs) -> str:
+    """
+    Completion text; cancelling the awaiting task aborts the request.
+    timeout is a wall-clock limit for the whole call (queueing included):
+    the answer is streamed and, when the limit passes, the stream is closed
+    and TruncatedCompletion carries the text received so far.
+    """
+    if timeout is None:
+        response = await achat_completion(messages, model=model, **kwargs)
+        return response.choices[0].message.content
+
+    parts = []
+
+    async def consume():
+        async for token in get_pool().astream_chat(messages, model=model, timeout=timeout, **kwargs):
+            parts.append(token)
+
+    try:
+        await asyncio.wait_for(consume(), timeout)
+    except asyncio.TimeoutError:
+        expired = TimeoutError(f"{timeout:.1f}s wall-clock deadline reached")
+        raise TruncatedCompletion("".join(parts), "LM Studio", expired) from expired
+    return "".join(parts)
+
+
+def chat_completion(messages: list, model: str = DEFAULT_MODEL, **kwargs):
+    return run_sync(achat_completion(messages, model=model, **kwargs))
+
+
+def generate(messages: list, model: str = DEFAULT_MODEL, cancel: CancelToken = None, **kwargs) -> str:
+    """Completion text. Cancelling the token aborts the HTTP request and raises Cancelled."""
+    return run_sync(agenerate(messages, model=model, **kwargs), cancel=cancel)
@@ -1,50 +1,35 @@
-import os
-import requests
-from openai import OpenAI
-
-LM_STUDIO_URL = "http://localhost:1234/v1/chat/completions"
-OPENAI_MODEL = "gpt-4o-mini"
+from llm_pool import get_pool
+from hedging import ahedged_completion, get_openai_client, OPENAI_MODEL
+from event_loop import run_sync
+from rate_limit import limiter, estimate_tokens
 
 def is_lm_studio_available(timeout=1.5):
-    try:
-        r = requests.post(
-            LM_STUDIO_URL,
-            json={
-                "model": "local",
-                "messages": [{"role": "user", "content": "ping"}],
-                "max_tokens": 1
-            },
-            timeout=timeout,
-        )
-        return r.status_code == 200
-    except:
-        return False
+    # Health is tracked passively by the endpoint pool (ejection on errors),
+    # so no ping round-trip is spent before every request.
+    return get_pool().is_available()
 
 
-def generate_response(messages):
-    # 1️⃣ Try LM Studio first
+async def agenerate_response(messages, mode="normal"):
+    # 1️⃣ Local endpoint pool first, hedged to OpenAI when it is slow
     if is_lm_studio_available():
         try:
-            r = requests.post(
-                LM_STUDIO_URL,
-                json={
-                    "model": "local",
-                    "messages": messages,
-                    "temperature": 0.7
-                },
-                timeout=60,
-            )
-            data = r.json()
-            return data["choices"][0]["message"]["content"], "LM Studio"
-        except:
+            return await ahedged_completion(messages, mode=mode, temperature=0.7)
+        except Exception:
             pass
 
     # 2️⃣ Fallback to OpenAI
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    completion = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=messages,
-        temperature=0.7,
-    )
+    client = get_openai_client()
+    if client is None:
+        raise RuntimeError("No healthy LLM endpoint and OPENAI_API_KEY is not set")
+    async with limiter("openai").aslot(estimate_tokens(messages)):
+        completion = await client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=messages,
+            temperature=0.7,
+        )
 
     return completion.choices[0].message.content, "OpenAI"
+
+
+def generate_response(messages, mode="normal"):
+    return run_sync(agenerate_response(messages, mode=mode))
@@ -0,0 +1,136 @@
+# -------------------------------------------------
+# perf_regression.py — Replay-based latency/throughput regression check
+# -------------------------------------------------
+#
+# Backend timing is taken out of the picture by replaying a cassette
+# (see recorder.py), so differences between runs come from OUR code:
+# planner, searcher, writer, retrieval post-processing, pool, hedging.
+#
+#   python perf_regression.py record                    # live run -> cassette
+#   python perf_regression.py replay --update-baseline  # store reference timings
+#   python perf_regression.py replay                    # compare, exit 1 on regression
+#
+# Prompts: the first user message of every sessions/*.json plus the titles
+# in requests.jsonl (when present).
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+
+CASSETTE = os.path.join("cassettes", "regression.json")
+BASELINE = os.path.join("cassettes", "baseline.json")
+
+
+def load_prompts(limit: int = None) -> list:
+    prompts = []
+    for path in sorted(glob.glob(os.path.join("sessions", "*.json"))):
+        try:
+            with open(path, "r", encoding="utf-8") as fh:
+                messages = json.load(fh).get("messages", [])
+        except (OSError, ValueError):
+            continue
+        first = next((m["content"] for m in messages if m.get("role") == "user"), None)
+        if first:
+            prompts.append(first.strip()[:300])
+
+    if os.path.exists("requests.jsonl"):
+        with open("requests.jsonl", "r", encoding="utf-8") as fh:
+            for line in fh:
+                try:
+                    title = json.loads(line).get("title")
+                except ValueError:
+                    continue
+                if title:
+                    prompts.append(title)
+
+    prompts = list(dict.fromkeys(prompts))
+    return prompts[:limit] if limit else prompts
+
+
+def run_suite(prompts: list) -> dict:
+    # Imported late: clients must be built after the cassette is configured
+    from pipeline import run_langgraph_pipeline
+    from research_assistant import web_search
+
+    timings = {}
+    suite_start = time.perf_counter()
+    for prompt in prompts:
+        start = time.perf_counter()
+        web_search(prompt)
+        run_langgraph_pipeline(prompt, mode="normal")
+        timings[prompt] = round(time.perf_counter() - start, 4)
+        print(f"  {timings[prompt]:8.3f}s  {prompt[:70]}")
+    total = time.perf_counter() - suite_start
+    return {
+        "timings": timings,
+        "total_seconds": round(total, 4),
+        "prompts_per_minute": round(60 * len(prompts) / total, 3) if total else 0.0,
+    }
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for prompt, seconds in current["timings"].items():
+        ref = baseline["timings"].get(prompt)
+        if ref and seconds > ref * (1 + tolerance):
+            regressions.append(f"{prompt[:60]!r}: {ref:.3f}s -> {seconds:.3f}s")
+    ref_tp = baseline.get("prompts_per_minute") or 0
+    if ref_tp and current["prompts_per_minute"] < ref_tp * (1 - tolerance):
+        regressions.append(f"throughput: {ref_tp:.2f} -> {current['prompts_per_minute']:.2f} prompts/min")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay-based performance regression suite")
+    parser.add_argument("action", choices=["record", "replay"])
+    parser.add_argument("--cassette", default=CASSETTE)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--speed", type=float, default=1.0, help="replay timing scale (0 = no delays)")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown fraction")
+    parser.add_argument("--limit", type=int, default=None, help="max prompts")
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    # Deterministic routing: no hedge races against OpenAI during the suite
+    os.environ["HEDGE_ENABLED"] = "0"
+    if args.action == "record" and os.path.exists(args.cassette):
+        os.remove(args.cassette)
+
+    import recorder
+    recorder.configure(args.cassette, args.action, args.speed)
+
+    prompts = load_prompts(args.limit)
+    print(f"[{args.action}] {len(prompts)} prompts")
+    current = run_suite(prompts)
+    print(f"Total {current['total_seconds']:.2f}s, {current['prompts_per_minute']:.2f} prompts/min")
+
+    if args.action == "record":
+        print(f"Cassette written to {args.cassette}")
+        return 0
+
+    if args.update_baseline or not os.path.exists(args.baseline):
+        with open(args.baseline, "w", encoding="utf-8") as fh:
+            json.dump(dict(current, speed=args.speed), fh, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    with open(args.baseline, "r", encoding="utf-8") as fh:
+        baseline = json.load(fh)
+    if baseline.get("speed", 1.0) != args.speed:
+        print(f"⚠️ Baseline was taken at --speed {baseline.get('speed')}, timings are not comparable")
+
+    regressions = compare(current, baseline, args.tolerance)
+    if regressions:
+        print("REGRESSIONS:")
+        for r in regressions:
+            print(f"  - {r}")
+        return 1
+    print("No regressions.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,46 +2,184 @@
 # pipeline.py  — Complete LangGraph Pipeline (Fixed)
 # -------------------------------------------------
 
-from Planner import planner_agent
-from research_assistant import searcher_agent
-from writer import writer_agent
+import sys
+import queue
+import asyncio
+import argparse
+import threading
+from typing import Callable, Dict, Iterator
+
+from Planner import aplanner_agent
+from research_assistant import asearcher_agent
+from writer import awriter_agent
+from budget import Budget
+from profiling import profile_run
+from cancellation import CancelToken, Cancelled, count as count_metric
+from event_loop import run_sync, cancel_requested
 
 
 def run_langgraph_pipeline(
     user_query: str,
     mode: str = "normal",
-    use_openai_polish: bool = False
+    use_openai_polish: bool = False,
+    deadline: float = None,
+    on_event: Callable[[Dict], None] = None,
+    profile: bool = None,
+    cancel: CancelToken = None,
+    answered: Dict = None,
+    memory: str = None
 ):
     """
     Main LangGraph Pipeline
     mode = normal / deep research / summary / academic / code
+    deadline = optional latency budget in seconds (or a Budget); stages
+               shrink their work to fit and report what was skipped
+    on_event = optional callback for progress events (see stream_pipeline)
+    profile  = force CPU/memory profiling of this run (default: ODR_PROFILE)
+    cancel   = optional CancelToken; raises Cancelled once it fires
+    answered = optional {question: answer} already researched this session;
+               overlapping planned questions reuse those answers
+    memory   = optional conversation context block (conversation_memory.py)
+               given to the searcher and writer for follow-up queries
     """
+    with profile_run(f"pipeline-{mode}", enabled=profile):
+        return run_sync(
+            arun_pipeline(user_query, mode, use_openai_polish, deadline, on_event, answered, memory),
+            cancel=cancel
+        )
+
 
+async def arun_pipeline(
+    user_query: str,
+    mode: str = "normal",
+    use_openai_polish: bool = False,
+    deadline: float = None,
+    on_event: Callable[[Dict], None] = None,
+    answered: Dict = None,
+    memory: str = None
+) -> Dict:
+    """
+    Coroutine behind run_langgraph_pipeline(); cancelling the awaiting task
+    aborts the in-flight LLM and search calls.
+    """
     print(f"[Pipeline Mode] {mode}")
+    count_metric("runs_started")
+    budget = Budget.coerce(deadline)
+    emit = on_event or (lambda event: None)
 
-    # 1️⃣ STEP 1 — PLAN
-    plan = planner_agent(user_query)
+    try:
+        # 1️⃣ STEP 1 — PLAN
+        plan = await aplanner_agent(user_query, budget=budget, answered=answered)
 
-    # planner_agent must return {'topic': str, 'questions': list}
-    topic = plan.get("topic", user_query)
-    questions = plan.get("questions", [])
+        # planner_agent must return {'topic': str, 'questions': list, 'reused': dict}
+        topic = plan.get("topic", user_query)
+        questions = plan.get("questions", [])
+        reused = plan.get("reused", {})
+        emit({"type": "plan_ready", "topic": topic, "questions": questions, "reused": list(reused)})
+        for question, answer in reused.items():
+            emit({"type": "answer_ready", "question": question, "answer": answer, "reused": True})
 
-    # 2️⃣ STEP 2 — SEARCH / RESEARCH
-    # searcher_agent must return:
-    # { question: { 'content': ..., 'sources': ..., 'images': ... } }
-    answers = searcher_agent(questions)
+        # 2️⃣ STEP 2 — SEARCH / RESEARCH
+        # searcher_agent must return:
+        # { question: { 'content': ..., 'sources': ..., 'images': ... } }
+        answers = dict(reused)
+        answers.update(await asearcher_agent(questions, budget=budget, on_event=emit, memory=memory))
 
-    # 3️⃣ STEP 3 — WRITE FINAL RESULT (with optional OpenAI polishing)
-    final_text = writer_agent(
-        topic=topic,
-        qa_pairs=answers,
-        use_openai=use_openai_polish
-    )
+        # 3️⃣ STEP 3 — WRITE FINAL RESULT (with optional OpenAI polishing)
+        emit({"type": "writer_started", "topic": topic})
+        final_text = await awriter_agent(
+            topic=topic,
+            qa_pairs=answers,
+            use_openai=use_openai_polish,
+            mode=mode,
+            budget=budget,
+            on_token=lambda token: emit({"type": "token", "text": token}),
+            memory=memory
+        )
+    except asyncio.CancelledError:
+        # a CancelToken counts its own cancellation; plain task cancels are counted here
+        if not cancel_requested():
+            count_metric("runs_cancelled")
+        raise
+
+    budget_note = budget.summary()
+    if budget_note:
+        final_text = f"{final_text}\n\n{budget_note}"
+    count_metric("runs_completed")
 
     # 4️⃣ STEP 4 — RETURN FULL RESULT STRUCTURE
     return {
         "topic": topic,
         "answers": answers,
         "final_text": final_text,
-        "mode": mode
+        "mode": mode,
+        "skipped": budget.skipped
     }
+
+
+def stream_pipeline(user_query: str, cancel: CancelToken = None, heartbeat: float = 0.5, **kwargs) -> Iterator[Dict]:
+    """
+    Runs the pipeline on a worker thread and yields its events as they occur.
+    Closing the generator before the run finishes (consumer abandoned it)
+    cancels the run.
+
+      plan_ready       {topic, questions, reused}
+      question_started {question, index, total}
+      question_skipped {question}
+      answer_ready     {question, answer[, reused]}
+      writer_started   {topic}
+      token            {text}
+      heartbeat        {}         — every `heartbeat` seconds without events
+      done             {result}   — always last on success
+      error            {error}    — always last on failure
+      cancelled        {reason}   — always last when cancelled
+    """
+    cancel = cancel or CancelToken()
+    events: "queue.Queue[Dict]" = queue.Queue()
+
+    def worker():
+        try:
+            result = run_langgraph_pipeline(user_query, on_event=events.put, cancel=cancel, **kwargs)
+            events.put({"type": "done", "result": result})
+        except Cancelled as c:
+            events.put({"type": "cancelled", "reason": c.reason})
+        except Exception as e:
+            events.put({"type": "error", "error": e})
+
+    threading.Thread(target=worker, daemon=True, name="pipeline").start()
+
+    finished = False
+    try:
+        while True:
+            try:
+                event = events.get(timeout=heartbeat)
+            except queue.Empty:
+                event = {"type": "heartbeat"}
+            if event["type"] in ("done", "error", "cancelled"):
+                finished = True
+            yield event
+            if finished:
+                return
+    finally:
+        if not finished:
+            cancel.cancel("abandoned by consumer")
+
+
+# -------------------------------------------------
+# Batch usage: python pipeline.py "topic" [--mode normal] [--deadline 90] [--profile]
+# -------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the research pipeline once.")
+    parser.add_argument("query")
+    parser.add_argument("--mode", default="normal")
+    parser.add_argument("--deadline", type=float, default=None, help="latency budget in seconds")
+    parser.add_argument("--profile", action="store_true", help="write cProfile/tracemalloc reports to ./profiles")
+    args = parser.parse_args()
+
+    result = run_langgraph_pipeline(
+        args.query,
+        mode=args.mode,
+        deadline=args.deadline,
+        profile=args.profile or None
+    )
+    sys.stdout.write(result["final_text"] + "\n")
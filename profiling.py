@@ -0,0 +1,191 @@
+# -------------------------------------------------
+# profiling.py — Opt-in CPU / memory profiling of research runs
+# -------------------------------------------------
+#
+# Enable per run with any of:
+#   ODR_PROFILE=1                        (environment, every run)
+#   ?profile=1                           (Streamlit query param, one request)
+#   python pipeline.py "..." --profile   (batch flag)
+#
+# Each profiled run writes to $ODR_PROFILE_DIR (default ./profiles/<run>/):
+#   cprofile.prof       cProfile stats (snakeviz, pstats)
+#   cprofile.txt        top functions by cumulative time
+#   stacks.collapsed    sampled stacks of ALL threads, flamegraph.pl /
+#                       speedscope "collapsed" format
+#   allocations.txt     tracemalloc top allocation sites + peak memory
+#
+# Agent coroutines called through event_loop.run_sync() inside a
+# profile_run() run on the profiled thread, so cProfile sees them.
+#
+# When disabled, profile_run() is a flag check and a bare yield.
+
+import io
+import os
+import sys
+import time
+import json
+import pstats
+import cProfile
+import threading
+import functools
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+PROFILE_ENV = "ODR_PROFILE"
+PROFILE_DIR = os.getenv("ODR_PROFILE_DIR", "profiles")
+SAMPLE_INTERVAL = 0.005   # seconds between stack samples
+TOP_N = 40
+
+# Only the outermost profiled call records; nested hooks are no-ops
+_active = threading.Lock()
+_thread = threading.local()
+
+
+def profiling_this_thread() -> bool:
+    """True inside a recording profile_run() on the calling thread."""
+    return getattr(_thread, "profiling", False)
+
+
+def profiling_requested(flag: bool = None) -> bool:
+    if flag is not None:
+        return bool(flag)
+    return os.getenv(PROFILE_ENV, "").lower() in ("1", "true", "yes")
+
+
+# ===============================================================
+# STACK SAMPLER (all threads -> collapsed stacks)
+# ===============================================================
+class _StackSampler(threading.Thread):
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        super().__init__(daemon=True, name="profile-sampler")
+        self.interval = interval
+        self.stacks = Counter()
+        self._halt = threading.Event()
+
+    def run(self):
+        me = threading.get_ident()
+        names = {}
+        while not self._halt.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if ident not in names:
+                    names[ident] = next((t.name for t in threading.enumerate() if t.ident == ident), str(ident))
+                stack.append(names[ident])
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._halt.set()
+        self.join()
+
+    def write(self, path: str):
+        with open(path, "w", encoding="utf-8") as fh:
+            for stack, count in self.stacks.most_common():
+                fh.write(f"{stack} {count}\n")
+
+
+# ===============================================================
+# REPORT WRITERS
+# ===============================================================
+def _write_cprofile(profiler: cProfile.Profile, run_dir: str):
+    profiler.dump_stats(os.path.join(run_dir, "cprofile.prof"))
+    buf = io.StringIO()
+    pstats.Stats(profiler, stream=buf).sort_stats("cumulative").print_stats(TOP_N)
+    with open(os.path.join(run_dir, "cprofile.txt"), "w", encoding="utf-8") as fh:
+        fh.write(buf.getvalue())
+
+
+def _write_allocations(snapshot: tracemalloc.Snapshot, peak: int, run_dir: str):
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ])
+    with open(os.path.join(run_dir, "allocations.txt"), "w", encoding="utf-8") as fh:
+        fh.write(f"Peak traced memory: {peak / 1024 / 1024:.2f} MiB\n\n")
+        fh.write(f"Top {TOP_N} allocation sites (by size):\n")
+        for stat in snapshot.statistics("lineno")[:TOP_N]:
+            fh.write(f"{stat}\n")
+        fh.write("\nTracebacks of the 5 largest sites:\n")
+        for stat in snapshot.statistics("traceback")[:5]:
+            fh.write(f"\n{stat.size / 1024:.1f} KiB in {stat.count} blocks\n")
+            for line in stat.traceback.format():
+                fh.write(f"{line}\n")
+
+
+# ===============================================================
+# PUBLIC API
+# ===============================================================
+@contextmanager
+def profile_run(name: str, enabled: bool = None):
+    """
+    Profiles the enclosed block when enabled (or ODR_PROFILE is set).
+    Yields the output directory, or None when not profiling.
+    """
+    if not profiling_requested(enabled) or not _active.acquire(blocking=False):
+        yield None
+        return
+
+    try:
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        safe_name = "".join(c if c.isalnum() or c in "-_" else "_" for c in name)[:40]
+        run_dir = os.path.join(PROFILE_DIR, f"{stamp}_{safe_name}")
+        os.makedirs(run_dir, exist_ok=True)
+
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(25)
+        tracemalloc.reset_peak()
+        sampler = _StackSampler()
+        profiler = cProfile.Profile()
+
+        sampler.start()
+        wall_start = time.perf_counter()
+        profiler.enable()
+        _thread.profiling = True
+        try:
+            yield run_dir
+        finally:
+            _thread.profiling = False
+            profiler.disable()
+            wall = time.perf_counter() - wall_start
+            sampler.stop()
+            snapshot = tracemalloc.take_snapshot()
+            _current, peak = tracemalloc.get_traced_memory()
+            if started_tracing:
+                tracemalloc.stop()
+
+            _write_cprofile(profiler, run_dir)
+            sampler.write(os.path.join(run_dir, "stacks.collapsed"))
+            _write_allocations(snapshot, peak, run_dir)
+            with open(os.path.join(run_dir, "summary.json"), "w", encoding="utf-8") as fh:
+                json.dump({
+                    "name": name,
+                    "wall_seconds": round(wall, 4),
+                    "peak_traced_bytes": peak,
+                    "stack_samples": sum(sampler.stacks.values()),
+                }, fh, indent=2)
+            print(f"[Profile] {name}: {wall:.2f}s, peak {peak / 1024 / 1024:.1f} MiB -> {run_dir}")
+    finally:
+        _active.release()
+
+
+def profiled(name: str = None):
+    """Decorator form of profile_run, toggled by ODR_PROFILE."""
+    def decorator(fn):
+        label = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not profiling_requested():
+                return fn(*args, **kwargs)
+            with profile_run(label):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
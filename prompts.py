@@ -0,0 +1,263 @@
+# -------------------------------------------------
+# prompts.py — Prompt template registry with cache-friendly layout
+# -------------------------------------------------
+#
+# LM Studio / llama.cpp reuse the KV cache for the longest prompt prefix
+# they have already processed. Every template therefore has a FIXED
+# system message (instructions, output structure — no variables) and a
+# short user "tail" that carries the per-call values last. The five
+# searcher calls of a run, and calls from different users, then share
+# the same prefill-cached prefix.
+#
+# build() returns a normal messages list tagged with its template name;
+# the endpoint pool reports per-call prefill estimates, server-reported
+# cached tokens and time-to-first-token back here (record_call), split
+# into cold (prefix not yet seen by that endpoint) and warm calls.
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict
+
+MAX_TRACKED_PREFIXES = 256
+
+
+class PromptMessages(list):
+    """A messages list that remembers which template produced it."""
+
+    def __init__(self, messages, template: str, prefix_hash: str):
+        super().__init__(messages)
+        self.template = template
+        self.prefix_hash = prefix_hash
+
+
+class PromptTemplate:
+    def __init__(self, name: str, system: str, tail: str):
+        self.name = name
+        self.system = system.strip()
+        self.tail = tail.strip()
+        self.prefix_hash = hashlib.sha256(self.system.encode("utf-8")).hexdigest()[:16]
+        self.prefix_tokens = _tokens(self.system)
+
+    def render(self, memory: str = None, **values) -> PromptMessages:
+        tail = self.tail.format(**values)
+        if memory:
+            tail = f"Conversation context (for resolving follow-ups):\n{memory}\n\n{tail}"
+        return PromptMessages(
+            [
+                {"role": "system", "content": self.system},
+                {"role": "user", "content": tail},
+            ],
+            self.name,
+            self.prefix_hash,
+        )
+
+
+def _tokens(text: str) -> int:
+    return len(text) // 4
+
+
+# ===============================================================
+# TEMPLATES
+# ===============================================================
+_REPORT_RULES = """
+Write in clear Markdown. Start every section with its number and title
+on its own line (e.g. "1. Definition"). Use bullet points for lists and
+a fenced code block for diagrams. Base the document on the retrieved
+information the user provides; say so when something is not covered.
+"""
+
+TEMPLATES: Dict[str, PromptTemplate] = {}
+
+
+def register(name: str, system: str, tail: str) -> PromptTemplate:
+    TEMPLATES[name] = PromptTemplate(name, system, tail)
+    return TEMPLATES[name]
+
+
+register(
+    "searcher",
+    system="""
+You are a research assistant gathering material for a research report.
+Provide detailed, factual information that answers the question you are
+given: definitions, how it works, concrete examples and figures where
+known. Do not add an introduction or closing remarks.
+""",
+    tail="Question: {question}",
+)
+
+register(
+    "writer_factual",
+    system="You are an expert assistant. Answer the question concisely in 1-2 sentences.",
+    tail="Question: {topic}",
+)
+
+register(
+    "writer_compact",
+    system="""
+You are an expert AI research writer. Write a concise research brief.
+""" + _REPORT_RULES + """
+Follow this structure exactly:
+
+1. Definition
+2. Explanation
+3. Pros
+4. Cons
+5. Applications / Use Cases
+6. Final Summary
+""",
+    tail="Topic: **{topic}**\n\nRetrieved information:\n{context}",
+)
+
+register(
+    "writer_full",
+    system="""
+You are an expert AI research writer. Write a complete research document.
+""" + _REPORT_RULES + """
+Follow this structure exactly:
+
+1. Definition
+2. Explanation (Detailed)
+3. TYPES (Detailed)
+4. Key Features
+5. Pros
+6. Cons
+7. Applications / Use Cases
+8. Architecture / Flow Diagram (ASCII)
+9. Examples
+10. Glossary
+11. References
+12. Final Summary
+""",
+    tail="Topic: **{topic}**\n\nRetrieved information:\n{context}",
+)
+
+register(
+    "polish",
+    system="Improve clarity, structure, and readability of the research document you are given. "
+           "Keep its section structure and all facts.",
+    tail="{text}",
+)
+
+register(
+    "strict_research",
+    system="""
+You are an academic research assistant. Provide an academic research
+summary on the given topic. List peer-reviewed papers with DOI, arXiv, or
+PDF links (IEEE, Springer, Elsevier, PubMed, ACM).
+""",
+    tail="Topic: {topic}",
+)
+
+register(
+    "top5_papers",
+    system="Find the top 5 academic research papers on the given topic. "
+           "Return only titles and links (DOI, arXiv, PDF).",
+    tail="Topic: {topic}",
+)
+
+register(
+    "merged_research",
+    system="Provide complete research on the given topic. "
+           "Include academic papers and general web articles with links.",
+    tail="Topic: {topic}",
+)
+
+register(
+    "fast_summary",
+    system="Give a fast and quick summary of the given topic in fewer lines.",
+    tail="Topic: {query}",
+)
+
+register(
+    "web_summary",
+    system="Summarize the web search results you are given in a concise and informative way. "
+           "Cite passages as [n].",
+    tail="Topic: {query}\n\nSearch results:\n{results}",
+)
+
+register(
+    "memory_summary",
+    system="""
+You maintain a running summary of a research conversation. Merge the new
+turns into the current summary: keep the topics researched, key facts and
+conclusions, and any preferences the user stated. Drop pleasantries and
+formatting. Reply with the updated summary only, in at most 150 words.
+""",
+    tail="Current summary:\n{summary}\n\nNew turns:\n{turns}",
+)
+
+
+def build(name: str, memory: str = None, **values) -> PromptMessages:
+    """
+    memory: optional conversation context block; it goes between the fixed
+    prefix and the tail, so calls within one run still share a prefix.
+    """
+    return TEMPLATES[name].render(memory=memory, **values)
+
+
+# ===============================================================
+# PREFILL / CACHE STATS
+# ===============================================================
+_seen: "OrderedDict[tuple, bool]" = OrderedDict()    # (endpoint, prefix hash)
+_stats: Dict[str, Dict] = {}
+_lock = threading.Lock()
+
+
+def _template_stats(name: str) -> Dict:
+    if name not in _stats:
+        _stats[name] = {
+            "calls": 0, "warm_calls": 0, "prefix_tokens": TEMPLATES[name].prefix_tokens,
+            "prefill_tokens": 0, "reusable_tokens": 0, "server_cached_tokens": 0,
+            "ttft_cold_total": 0.0, "ttft_cold_n": 0, "ttft_warm_total": 0.0, "ttft_warm_n": 0,
+        }
+    return _stats[name]
+
+
+def _server_cached_tokens(usage) -> int:
+    details = getattr(usage, "prompt_tokens_details", None)
+    return int(getattr(details, "cached_tokens", 0) or 0)
+
+
+def record_call(messages, endpoint: str, ttft: float = None, usage=None):
+    """Called by the endpoint pool for every templated request."""
+    name = getattr(messages, "template", None)
+    if name not in TEMPLATES:
+        return
+    prefill = sum(_tokens(str(m.get("content", ""))) for m in messages)
+    key = (endpoint, messages.prefix_hash)
+    with _lock:
+        warm = key in _seen
+        _seen[key] = True
+        _seen.move_to_end(key)
+        while len(_seen) > MAX_TRACKED_PREFIXES:
+            _seen.popitem(last=False)
+
+        s = _template_stats(name)
+        s["calls"] += 1
+        s["warm_calls"] += int(warm)
+        s["prefill_tokens"] += prefill
+        s["reusable_tokens"] += s["prefix_tokens"] if warm else 0
+        if usage is not None:
+            s["server_cached_tokens"] += _server_cached_tokens(usage)
+        if ttft is not None:
+            bucket = "warm" if warm else "cold"
+            s[f"ttft_{bucket}_total"] += ttft
+            s[f"ttft_{bucket}_n"] += 1
+
+
+def prompt_stats() -> Dict[str, Dict]:
+    with _lock:
+        report = {}
+        for name, s in _stats.items():
+            report[name] = {
+                "calls": s["calls"],
+                "prefix_tokens": s["prefix_tokens"],
+                "avg_prefill_tokens": round(s["prefill_tokens"] / s["calls"]) if s["calls"] else 0,
+                "prefix_reuse_rate": round(s["warm_calls"] / s["calls"], 3) if s["calls"] else 0.0,
+                "reusable_tokens": s["reusable_tokens"],
+                "server_cached_tokens": s["server_cached_tokens"],
+                "ttft_cold_ms": round(1000 * s["ttft_cold_total"] / s["ttft_cold_n"]) if s["ttft_cold_n"] else None,
+                "ttft_warm_ms": round(1000 * s["ttft_warm_total"] / s["ttft_warm_n"]) if s["ttft_warm_n"] else None,
+            }
+        return report
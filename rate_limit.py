@@ -0,0 +1,283 @@
+# -------------------------------------------------
+# rate_limit.py — Client-side rate limiting + adaptive concurrency
+# -------------------------------------------------
+#
+# One BackendLimiter per backend ("lmstudio", "openai", "tavily"):
+#   - token buckets for requests/minute and tokens/minute (0 = unlimited)
+#   - an AIMD concurrency controller: +1 slot per "window" of healthy
+#     calls, x0.5 on 429s, timeouts or latency spikes
+#
+# Environment (per backend, upper-case name):
+#   <NAME>_RPM, <NAME>_TPM            e.g. OPENAI_RPM=500, OPENAI_TPM=200000
+#   <NAME>_MAX_CONCURRENCY            ceiling for the AIMD controller
+
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict
+
+from event_loop import Waiters
+
+# name: (rpm, tpm, initial concurrency, max concurrency)
+DEFAULTS = {
+    "lmstudio": (0, 0, 4, 32),
+    "openai": (500, 200_000, 8, 64),
+    "tavily": (100, 0, 4, 16),
+}
+
+LATENCY_SPIKE_FACTOR = 3.0    # latency > 3x baseline counts as overload
+
+
+class RateLimited(RuntimeError):
+    """Raised when a slot could not be obtained within the caller's timeout."""
+
+
+# ===============================================================
+# TOKEN BUCKET
+# ===============================================================
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def unlimited(self) -> bool:
+        return not self.per_minute
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.per_minute / 60.0)
+        self.updated = now
+
+    def reserve(self, amount: float, timeout: float = None) -> float:
+        """
+        Takes `amount` now, borrowing against future refill, and returns how
+        long the caller must wait before using it. Each caller queues behind
+        the reservations made before it, so waiters are served in order and
+        sleep exactly once.
+        """
+        if self.unlimited or amount <= 0:
+            return 0.0
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill()
+            wait = max(0.0, (amount - self.tokens) * 60.0 / self.per_minute)
+            if timeout is not None and wait > timeout:
+                raise RateLimited("rate limit wait exceeded timeout")
+            self.tokens -= amount
+            return wait
+
+    def adjust(self, delta: float):
+        """Debit (positive) or refund (negative) after the real cost is known."""
+        if self.unlimited:
+            return
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - delta)
+
+
+# ===============================================================
+# AIMD CONCURRENCY CONTROLLER
+# ===============================================================
+class AIMDController:
+    def __init__(self, initial: int, maximum: int, minimum: int = 1, decrease: float = 0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.in_flight = 0
+        self.baseline_latency = None
+        self._lock = threading.Lock()
+        self._waiters = Waiters(give_back=lambda _: self.release())
+
+    async def acquire(self, timeout: float = None):
+        """Waits for a slot; freed slots are handed to waiters in arrival order."""
+        with self._lock:
+            if not self._waiters and self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return
+            entry = self._waiters.enqueue()
+        try:
+            await asyncio.wait_for(entry.future, timeout)
+        except BaseException as e:
+            with self._lock:
+                granted = self._waiters.withdraw(entry)
+            if granted:
+                self.release()
+            if isinstance(e, asyncio.TimeoutError):
+                raise RateLimited("concurrency wait exceeded timeout") from None
+            raise
+
+    def _grant(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            if self._waiters.grant(next(iter(self._waiters)), True):
+                self.in_flight += 1
+
+    def release(self, latency: float = None, overloaded: bool = False):
+        with self._lock:
+            self.in_flight -= 1
+            if not overloaded and latency is not None and self.baseline_latency is not None:
+                overloaded = latency > LATENCY_SPIKE_FACTOR * self.baseline_latency
+            if overloaded:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+            elif latency is not None:
+                # additive increase: ~+1 slot per `limit` healthy completions
+                self.limit = min(self.maximum, self.limit + 1.0 / max(self.limit, 1.0))
+                self.baseline_latency = latency if self.baseline_latency is None \
+                    else 0.1 * latency + 0.9 * self.baseline_latency
+            self._grant()
+
+
+# ===============================================================
+# BACKEND LIMITER
+# ===============================================================
+def _is_overload(error: BaseException) -> bool:
+    if getattr(error, "status_code", None) == 429:
+        return True
+    name = type(error).__name__
+    return name in ("RateLimitError", "APITimeoutError", "Timeout", "ReadTimeout", "ConnectTimeout", "TimeoutError")
+
+
+class Ticket:
+    """Handed to the caller inside aslot(): lets it report what really happened."""
+
+    def __init__(self, tokens: int):
+        self.tokens = tokens
+        self.actual_tokens = None
+        self.overloaded = False
+        self.started = time.monotonic()
+
+    def start_clock(self):
+        """Latency is measured from here: call it once any further queueing is over."""
+        self.started = time.monotonic()
+
+    def mark_overload(self):
+        self.overloaded = True
+
+    def set_tokens(self, actual: int):
+        self.actual_tokens = actual
+
+
+class BackendLimiter:
+    def __init__(self, name: str, rpm: float, tpm: float, initial: int, maximum: int):
+        self.name = name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.concurrency = AIMDController(initial, maximum)
+        self._usage = deque()      # (time, tokens) of the last minute
+        self._lock = threading.Lock()
+        self.counters = {"calls": 0, "overloads": 0, "errors": 0}
+
+    @asynccontextmanager
+    async def aslot(self, tokens: int = 0, timeout: float = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def left():
+            return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+        reserved = []
+        try:
+            for bucket, amount in ((self.requests, 1), (self.tokens, tokens)):
+                wait = bucket.reserve(amount, left())
+                reserved.append((bucket, amount))
+                if wait:
+                    await asyncio.sleep(wait)
+            await self.concurrency.acquire(left())
+        except BaseException:
+            # never used: hand the reservations back
+            for bucket, amount in reserved:
+                bucket.adjust(-amount)
+            raise
+
+        ticket = Ticket(tokens)
+        try:
+            yield ticket
+        except BaseException as e:
+            self._finish(ticket, e)
+            raise
+        else:
+            self._finish(ticket)
+
+    def _finish(self, ticket: Ticket, error: BaseException = None):
+        if isinstance(error, (GeneratorExit, asyncio.CancelledError)):
+            # consumer closed a stream early — neither success nor overload
+            self.concurrency.release()
+            self._account(ticket, ticket.overloaded)
+        elif error is not None:
+            overloaded = ticket.overloaded or _is_overload(error)
+            self.concurrency.release(overloaded=overloaded)
+            self._account(ticket, overloaded, error=not overloaded)
+        else:
+            # seconds per token, so long generations are not mistaken for spikes
+            cost = ticket.actual_tokens or ticket.tokens
+            self.concurrency.release((time.monotonic() - ticket.started) / max(cost, 1), ticket.overloaded)
+            self._account(ticket, ticket.overloaded)
+
+    def _account(self, ticket: Ticket, overloaded: bool, error: bool = False):
+        used = ticket.tokens
+        if ticket.actual_tokens is not None:
+            self.tokens.adjust(ticket.actual_tokens - ticket.tokens)
+            used = ticket.actual_tokens
+        now = time.monotonic()
+        with self._lock:
+            self.counters["calls"] += 1
+            self.counters["overloads"] += int(overloaded)
+            self.counters["errors"] += int(error)
+            self._usage.append((now, used))
+            while self._usage and now - self._usage[0][0] > 60:
+                self._usage.popleft()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return dict(
+                self.counters,
+                rpm_limit=self.requests.per_minute or None,
+                tpm_limit=self.tokens.per_minute or None,
+                requests_last_minute=len(self._usage),
+                tokens_last_minute=sum(t for _, t in self._usage),
+                concurrency_limit=int(self.concurrency.limit),
+                in_flight=self.concurrency.in_flight,
+            )
+
+
+# ===============================================================
+# REGISTRY
+# ===============================================================
+_limiters: Dict[str, BackendLimiter] = {}
+_registry_lock = threading.Lock()
+
+
+def limiter(name: str) -> BackendLimiter:
+    with _registry_lock:
+        if name not in _limiters:
+            rpm, tpm, initial, maximum = DEFAULTS.get(name, (0, 0, 4, 16))
+            env = name.upper()
+            _limiters[name] = BackendLimiter(
+                name,
+                rpm=float(os.getenv(f"{env}_RPM", rpm)),
+                tpm=float(os.getenv(f"{env}_TPM", tpm)),
+                initial=initial,
+                maximum=int(os.getenv(f"{env}_MAX_CONCURRENCY", maximum)),
+            )
+        return _limiters[name]
+
+
+def prompt_tokens(messages: list) -> int:
+    return sum(len(str(m.get("content", ""))) for m in messages) // 4
+
+
+def estimate_tokens(messages: list, max_tokens: int = None) -> int:
+    """Prompt (~4 chars/token) + expected completion."""
+    return prompt_tokens(messages) + (max_tokens or 512)
+
+
+def limits_report() -> Dict[str, Dict]:
+    with _registry_lock:
+        names = list(_limiters)
+    return {name: limiter(name).stats() for name in names}
@@ -0,0 +1,228 @@
+# -------------------------------------------------
+# recorder.py — Transport-level record/replay of LLM and Tavily traffic
+# -------------------------------------------------
+#
+# AsyncOpenAI clients and the Tavily client are built through
+# async_http_client(). With a cassette configured every
+# request/response pair — including the arrival time of each streamed
+# chunk — is written to, or served from, a JSON cassette file.
+#
+# Environment:
+#   ODR_CASSETTE        path of the cassette file
+#   ODR_CASSETTE_MODE   "record" | "replay" (anything else: live traffic)
+#   ODR_REPLAY_SPEED    timing scale for replay: 1.0 = original timing,
+#                       0.5 = twice as fast, 0 = no delays (default 1.0)
+
+import os
+import json
+import time
+import asyncio
+import base64
+import hashlib
+import threading
+from typing import Dict, List, Optional
+
+import httpx
+
+CASSETTE_VERSION = 1
+
+
+class CassetteMiss(httpx.TransportError):
+    """Replay found no recorded interaction for a request."""
+
+
+# ===============================================================
+# CASSETTE FILE
+# ===============================================================
+def request_key(method: str, url: str, body: bytes) -> str:
+    try:
+        # normalize JSON so key order / whitespace do not matter
+        body = json.dumps(json.loads(body or b"null"), sort_keys=True).encode("utf-8")
+    except ValueError:
+        pass
+    digest = hashlib.sha256(body or b"").hexdigest()[:16]
+    return f"{method.upper()} {url} {digest}"
+
+
+class Cassette:
+    def __init__(self, path: str):
+        self.path = path
+        self.interactions: List[Dict] = []
+        self._lock = threading.Lock()
+        self._cursor: Dict[str, int] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as fh:
+                self.interactions = json.load(fh).get("interactions", [])
+
+    def add(self, interaction: Dict):
+        with self._lock:
+            self.interactions.append(interaction)
+            self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump({"version": CASSETTE_VERSION, "interactions": self.interactions}, fh, indent=1)
+        os.replace(tmp, self.path)
+
+    def match(self, key: str) -> Dict:
+        """Identical requests are served in recorded order; the last one repeats."""
+        with self._lock:
+            matches = [i for i in self.interactions if i["key"] == key]
+            if not matches:
+                raise CassetteMiss(f"No recorded interaction for {key}")
+            n = self._cursor.get(key, 0)
+            self._cursor[key] = n + 1
+            return matches[min(n, len(matches) - 1)]
+
+
+def _encode(chunk: bytes) -> str:
+    return base64.b64encode(chunk).decode("ascii")
+
+
+def _decode(chunk: str) -> bytes:
+    return base64.b64decode(chunk.encode("ascii"))
+
+
+# ===============================================================
+# HTTPX
+# ===============================================================
+def _saver(cassette: Cassette, key: str, request: httpx.Request, body: bytes,
+           response: httpx.Response, header_delay: float):
+    """Callback that stores the interaction once the body has been read."""
+    def save(chunks):
+        cassette.add({
+            "key": key,
+            "request": {"method": request.method, "url": str(request.url), "body": body.decode("utf-8", "replace")},
+            "response": {
+                "status": response.status_code,
+                "headers": list(response.headers.multi_items()),
+                "header_delay": header_delay,
+                "chunks": chunks,
+            },
+        })
+    return save
+
+
+class _AsyncRecordingStream(httpx.AsyncByteStream):
+    def __init__(self, inner, on_done, started: float):
+        self.inner = inner
+        self.on_done = on_done
+        self.started = started
+        self.chunks = []
+
+    async def __aiter__(self):
+        async for chunk in self.inner:
+            self.chunks.append([round(time.monotonic() - self.started, 4), _encode(chunk)])
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.inner.aclose()
+        finally:
+            self.on_done(self.chunks)
+
+
+class _AsyncReplayStream(httpx.AsyncByteStream):
+    def __init__(self, chunks: List, offset: float, speed: float):
+        self.chunks = chunks
+        self.offset = offset
+        self.speed = speed
+
+    async def __aiter__(self):
+        last = self.offset
+        for t, data in self.chunks:
+            if self.speed:
+                await asyncio.sleep(max(0.0, (t - last) * self.speed))
+            last = t
+            yield _decode(data)
+
+    async def aclose(self):
+        pass
+
+
+class AsyncCassetteTransport(httpx.AsyncBaseTransport):
+    def __init__(self, cassette: Cassette, mode: str, speed: float = 1.0):
+        self.cassette = cassette
+        self.mode = mode
+        self.speed = speed
+        self.live = httpx.AsyncHTTPTransport() if mode == "record" else None
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        key = request_key(request.method, str(request.url), body)
+
+        if self.mode == "replay":
+            rec = self.cassette.match(key)["response"]
+            if self.speed:
+                await asyncio.sleep(rec["header_delay"] * self.speed)
+            return httpx.Response(
+                rec["status"],
+                headers=rec["headers"],
+                stream=_AsyncReplayStream(rec["chunks"], rec["header_delay"], self.speed),
+                request=request,
+            )
+
+        started = time.monotonic()
+        response = await self.live.handle_async_request(request)
+        save = _saver(self.cassette, key, request, body, response, round(time.monotonic() - started, 4))
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            stream=_AsyncRecordingStream(response.stream, save, started),
+            request=request,
+            extensions=response.extensions,
+        )
+
+    async def aclose(self):
+        if self.live is not None:
+            await self.live.aclose()
+
+
+# ===============================================================
+# FACTORIES
+# ===============================================================
+_config = {"path": None, "mode": None, "speed": 1.0}
+_cassettes: Dict[str, Cassette] = {}
+_lock = threading.Lock()
+
+
+def configure(path: str = None, mode: str = None, speed: float = None):
+    """Overrides the environment; call before clients are created."""
+    _config["path"] = path
+    _config["mode"] = mode
+    if speed is not None:
+        _config["speed"] = speed
+
+
+def _settings():
+    path = _config["path"] or os.getenv("ODR_CASSETTE")
+    mode = (_config["mode"] or os.getenv("ODR_CASSETTE_MODE", "")).lower()
+    speed = _config["speed"] if _config["path"] else float(os.getenv("ODR_REPLAY_SPEED", "1.0"))
+    if not path or mode not in ("record", "replay"):
+        return None, None, speed
+    return path, mode, speed
+
+
+def _cassette(path: str) -> Cassette:
+    with _lock:
+        if path not in _cassettes:
+            _cassettes[path] = Cassette(path)
+        return _cassettes[path]
+
+
+def active_mode() -> Optional[str]:
+    return _settings()[1]
+
+
+def async_http_client(timeout: float = None, always: bool = False) -> Optional[httpx.AsyncClient]:
+    """
+    httpx.AsyncClient for AsyncOpenAI(http_client=...) or direct use.
+    Without a cassette: None (live default), or a plain client if `always`.
+    """
+    path, mode, speed = _settings()
+    kwargs = {"timeout": timeout} if timeout is not None else {}
+    if mode is None:
+        return httpx.AsyncClient(**kwargs) if always else None
+    return httpx.AsyncClient(transport=AsyncCassetteTransport(_cassette(path), mode, speed), **kwargs)
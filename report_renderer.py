@@ -0,0 +1,224 @@
+# -------------------------------------------------
+# report_renderer.py — One PDF engine for reports and session exports
+# -------------------------------------------------
+#
+# The writer's markdown is parsed line by line into blocks (headings,
+# numbered sections, bullets, code/ASCII diagrams, paragraphs) and drawn
+# straight onto a canvas, wrapping each block to the page width. There is
+# no platypus story: the working set is one block plus the current page,
+# and finished pages are stored compressed. Output is returned as bytes
+# (no files in the working directory) and cached by content hash.
+#
+# Environment:
+#   PDF_CACHE_ENTRIES   rendered PDFs kept in the LRU cache (default 16)
+#   PDF_RENDER_WORKERS  background render threads (default 2)
+
+import io
+import os
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Iterator, Tuple
+
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.utils import simpleSplit
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen import canvas
+
+PAGE_WIDTH, PAGE_HEIGHT = A4
+MARGIN = 50
+TEXT_WIDTH = PAGE_WIDTH - 2 * MARGIN
+
+# block kind: (font, size, leading, space before, indent)
+STYLES = {
+    "title": ("Helvetica-Bold", 16, 20, 0, 0),
+    "h1": ("Helvetica-Bold", 14, 18, 12, 0),
+    "h2": ("Helvetica-Bold", 12, 16, 10, 0),
+    "h3": ("Helvetica-Bold", 11, 14, 8, 0),
+    "para": ("Helvetica", 10, 13, 4, 0),
+    "bullet": ("Helvetica", 10, 13, 2, 14),
+    "code": ("Courier", 8, 10, 0, 8),
+}
+
+_HEADING = re.compile(r"^(#{1,6})\s+(.*)$")
+_SECTION = re.compile(r"^\*{0,2}(\d{1,2})[.)]\s+([^.:;,]{1,60}?)\*{0,2}$")
+_BULLET = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s+(.*)$")
+# markdown table rows, ASCII boxes, "[A] --> [B]" flow lines
+_DIAGRAM = re.compile(r"^(?:\||\+[-=+]|\[[^\]]*\]\s*[-=<]+>?)")
+_INLINE = re.compile(r"\*\*(.+?)\*\*|__(.+?)__|`([^`]+)`")
+
+
+# ===============================================================
+# MARKDOWN -> BLOCKS
+# ===============================================================
+def _plain(text: str) -> str:
+    """Drops inline markdown markers; Helvetica has no glyphs beyond Latin-1."""
+    text = _INLINE.sub(lambda m: next(g for g in m.groups() if g is not None), text)
+    return text.encode("latin-1", "replace").decode("latin-1")
+
+
+def _is_section(line: str, title: str) -> bool:
+    """Numbered section heading ("1. Definition") vs. a numbered step ("1. Install the package")."""
+    if line.startswith("**"):
+        return True
+    words = [w for w in re.findall(r"[A-Za-z][\w'-]*", title) if len(w) > 3]
+    return bool(words) and all(w[0].isupper() for w in words)
+
+
+def parse_blocks(text: str) -> Iterator[Tuple[str, str]]:
+    """
+    Yields (kind, text) blocks from the writer's markdown without
+    materializing the whole document; consecutive lines are joined into
+    one paragraph until a blank line or a structural line.
+    """
+    paragraph = []
+    in_code = False
+    for raw in io.StringIO(text or ""):
+        line = raw.rstrip("\n").rstrip()
+
+        if line.lstrip().startswith("```"):
+            if paragraph:
+                yield "para", " ".join(paragraph)
+                paragraph = []
+            in_code = not in_code
+            continue
+        if in_code:
+            yield "code", line
+            continue
+
+        stripped = line.strip()
+        heading = _HEADING.match(stripped)
+        section = _SECTION.match(stripped)
+        if section and not _is_section(stripped, section.group(2)):
+            section = None
+        bullet = _BULLET.match(line)
+        structural = not stripped or heading or section or bullet or set(stripped) <= set("-=_*")
+        if structural and paragraph:
+            yield "para", " ".join(paragraph)
+            paragraph = []
+
+        if not stripped or set(stripped) <= set("-=_*"):
+            continue
+        if heading:
+            yield f"h{min(len(heading.group(1)), 3)}", heading.group(2).strip("* ")
+        elif section:
+            yield "h2", f"{section.group(1)}. {section.group(2).strip('* ')}"
+        elif bullet:
+            yield "bullet", bullet.group(1)
+        elif _DIAGRAM.match(stripped):
+            # tables / ASCII flow diagrams keep their alignment
+            yield "code", line
+        else:
+            paragraph.append(stripped)
+
+    if paragraph:
+        yield "para", " ".join(paragraph)
+
+
+# ===============================================================
+# RENDERING
+# ===============================================================
+class _PageWriter:
+    def __init__(self, buffer, title: str):
+        self.canvas = canvas.Canvas(buffer, pagesize=A4, pageCompression=1)
+        self.canvas.setTitle(title or "report")
+        self.y = PAGE_HEIGHT - MARGIN
+        self.page = 1
+
+    def _new_page(self):
+        self._footer()
+        self.canvas.showPage()
+        self.page += 1
+        self.y = PAGE_HEIGHT - MARGIN
+
+    def _footer(self):
+        self.canvas.setFont("Helvetica", 8)
+        self.canvas.drawRightString(PAGE_WIDTH - MARGIN, MARGIN / 2, str(self.page))
+
+    def block(self, kind: str, text: str):
+        font, size, leading, before, indent = STYLES[kind]
+        if kind == "code":
+            # monospaced: wrap by character count, never drop text
+            text = _plain(text.expandtabs(4))
+            width = int((TEXT_WIDTH - indent) // stringWidth("M", font, size))
+            lines = [text[i:i + width] for i in range(0, len(text), width)] or [""]
+        else:
+            lines = simpleSplit(_plain(text), font, size, TEXT_WIDTH - indent) or [""]
+
+        # keep headings with at least one following line
+        needed = before + leading * (2 if kind.startswith("h") else 1)
+        if self.y - needed < MARGIN:
+            self._new_page()
+        elif self.y < PAGE_HEIGHT - MARGIN:
+            self.y -= before
+
+        for i, line in enumerate(lines):
+            if self.y - leading < MARGIN:
+                self._new_page()
+            self.y -= leading
+            self.canvas.setFont(font, size)
+            if kind == "bullet" and i == 0:
+                self.canvas.drawString(MARGIN + indent - 10, self.y, "-")
+            self.canvas.drawString(MARGIN + indent, self.y, line)
+
+    def finish(self):
+        self._footer()
+        self.canvas.save()
+
+
+def _render(text: str, title: str) -> bytes:
+    buffer = io.BytesIO()
+    writer = _PageWriter(buffer, title)
+    if title:
+        writer.block("title", title)
+    for kind, block in parse_blocks(text):
+        writer.block(kind, block)
+    writer.finish()
+    return buffer.getvalue()
+
+
+# ===============================================================
+# CACHE + BACKGROUND RENDERING
+# ===============================================================
+_cache: "OrderedDict[str, bytes]" = OrderedDict()
+_cache_lock = threading.Lock()
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("PDF_RENDER_WORKERS", "2")),
+    thread_name_prefix="pdf-render"
+)
+stats = {"renders": 0, "cache_hits": 0}
+
+
+def content_key(text: str, title: str = None) -> str:
+    digest = hashlib.sha256()
+    digest.update((title or "").encode("utf-8"))
+    digest.update(b"\0")
+    digest.update((text or "").encode("utf-8"))
+    return digest.hexdigest()
+
+
+def render_pdf(text: str, title: str = None) -> bytes:
+    """PDF bytes for a markdown report; identical content is rendered once."""
+    key = content_key(text, title)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            stats["cache_hits"] += 1
+            return _cache[key]
+
+    pdf = _render(text, title)
+
+    with _cache_lock:
+        stats["renders"] += 1
+        _cache[key] = pdf
+        _cache.move_to_end(key)
+        while len(_cache) > int(os.getenv("PDF_CACHE_ENTRIES", "16")):
+            _cache.popitem(last=False)
+    return pdf
+
+
+def render_pdf_async(text: str, title: str = None) -> Future:
+    """Starts rendering on a background thread; .result() gives the bytes."""
+    return _executor.submit(render_pdf, text, title)
@@ -1,22 +1,29 @@
 # research_assistant.py  (IMPROVED & FOR STREAMLIT UI)
 import os
-import requests
 import re
-from typing import List, Dict, Iterable
+import asyncio
+from typing import Callable, List, Dict, Iterable
 from urllib.parse import quote_plus
-from openai import OpenAI
 from dotenv import load_dotenv
+from llm_pool import agenerate, get_pool, TruncatedCompletion
+from budget import Budget, estimate, MIN_TRUNCATED_FRACTION
+from retrieval import select_passages
+from recorder import async_http_client
+from rate_limit import limiter
+from cancellation import CancelToken, count as count_metric
+from event_loop import run_sync, PerLoop
+from prompts import build as build_prompt
 
 load_dotenv()
 
 TAVILY_API_KEY = os.getenv("TAVILY_API_KEY")
+TAVILY_URL = "https://api.tavily.com/search"
 
-# Local LM Studio Client
-local_client = OpenAI(
-    base_url="http://localhost:1234/v1",
-    api_key="lm-studio",
-    timeout=180
-)
+# Shared HTTP client per event loop (connection reuse; record/replay aware)
+_http = PerLoop(lambda: async_http_client(20, always=True))
+
+# Budgeted searcher calls: typical answer length
+SEARCHER_MAX_TOKENS = 1024
 
 # -----------------------------
 # Small helper: safe listify
@@ -45,32 +52,35 @@ def fallback_search(question: str) -> Dict:
 # ===============================================================
 # GENERIC WEB SEARCH (TAVILY wrapper)
 # ===============================================================
-def web_search(query: str, max_results: int = 7) -> Dict:
+async def aweb_search(query: str, max_results: int = 7, token_budget: int = 1500) -> Dict:
+    """
+    Tavily search, post-processed into deduplicated, query-ranked passages
+    that fit token_budget. 'passages' keeps each passage's source URL.
+    """
     if not TAVILY_API_KEY:
         return fallback_search(query)
 
     headers = {"Authorization": f"Bearer {TAVILY_API_KEY}"}
     try:
-        resp = requests.post(
-            "https://api.tavily.com/search",
-            headers=headers,
-            json={"query": query, "max_results": max_results},
-            timeout=20
-        )
+        async with limiter("tavily").aslot() as ticket:
+            resp = await _http.get().post(
+                TAVILY_URL,
+                headers=headers,
+                json={"query": query, "max_results": max_results}
+            )
+            if resp.status_code == 429:
+                ticket.mark_overload()
         if resp.status_code != 200:
             return fallback_search(query)
 
         data = resp.json()
-        content_parts, sources = [], []
-
-        for item in data.get("results", []):
-            if item.get("content"):
-                content_parts.append(item["content"])
-            if item.get("url"):
-                sources.append(item["url"])
+        results = [item for item in data.get("results", []) if item.get("content")]
+        passages = select_passages(query, results, token_budget=token_budget)
+        sources = [item["url"] for item in data.get("results", []) if item.get("url")]
 
         return {
-            "content": "\n\n".join(content_parts).strip(),
+            "content": "\n\n".join(p["text"] for p in passages).strip(),
+            "passages": passages,
             "sources": list(dict.fromkeys(sources)),
             "images": data.get("images", [])
         }
@@ -79,25 +89,110 @@ def web_search(query: str, max_results: int = 7) -> Dict:
         return fallback_search(query)
 
 
+def web_search(query: str, max_results: int = 7, token_budget: int = 1500) -> Dict:
+    return run_sync(aweb_search(query, max_results, token_budget))
+
+
 # ===============================================================
 # SEARCHER AGENT
 # ===============================================================
-def searcher_agent(questions: Iterable[str]) -> Dict[str, Dict]:
-    answers = {}
-    for q in questions:
+def _budgeted_call(budget: Budget, question: str, wave: int = 0):
+    """
+    Call kwargs that fit the budget, or None when the question is skipped.
+    wave: how many full rounds of pool capacity run ahead of this question;
+          its answer is sized for the time left after them, while its
+          (wall-clock) timeout still spans the whole window.
+    """
+    if budget is None or budget.unlimited:
+        return {}
+    # keep the writer's share of the budget untouched
+    available = budget.remaining() - estimate("writer")
+    needed = estimate("searcher")
+    own = available - wave * needed
+    if own < needed * MIN_TRUNCATED_FRACTION:
+        budget.skip("searcher", question, "skipped, would exceed time budget")
+        return None
+    if own < needed:
+        budget.skip("searcher", question, "answer truncated to fit time budget")
+        return {
+            "max_tokens": max(64, int(SEARCHER_MAX_TOKENS * own / needed)),
+            "timeout": available,
+        }
+    return {"timeout": available}
+
+
+async def asearcher_agent(
+    questions: Iterable[str],
+    budget: Budget = None,
+    on_event: Callable[[Dict], None] = None,
+    memory: str = None
+) -> Dict[str, Dict]:
+    """
+    Answers every planner question concurrently (the pool and limiters cap
+    the real parallelism); the returned dict keeps the planner's order.
+    on_event (optional) receives question_started / question_skipped /
+    answer_ready events as they happen. Cancelling the task aborts the
+    in-flight answers; the unanswered ones are counted as skipped.
+    With a budget, questions are sized in waves of the pool's capacity;
+    an answer still streaming when its time runs out is cut off (partial
+    text kept, skip recorded), and one with no text by then is dropped
+    (question_skipped).
+    memory (optional) is the conversation context block for follow-ups.
+    Latencies are not fed to budget.observe(): concurrent calls would skew
+    the per-call estimate the planner sizes its waves with.
+    """
+    emit = on_event or (lambda event: None)
+    questions = list(questions)
+    answers, finished = {}, set()
+
+    async def answer(i: int, q: str, call_kwargs: Dict):
+        emit({"type": "question_started", "question": q, "index": i, "total": len(questions)})
         try:
-            response = local_client.chat.completions.create(
-                model="qwen2.5-7b-instruct-1m-q4",
-                messages=[{"role": "user", "content": f"Provide detailed information and answer to: {q}"}]
-            )
+            content = await agenerate(build_prompt("searcher", memory=memory, question=q), **call_kwargs)
             answers[q] = {
-                "content": response.choices[0].message.content,
+                "content": content,
                 "sources": [],
                 "images": []
             }
+        except TruncatedCompletion as e:
+            finished.add(q)
+            if not e.text:
+                # never got a turn before the deadline: nothing to hand the writer
+                budget.skip("searcher", q, "skipped, no answer within the time budget")
+                emit({"type": "question_skipped", "question": q})
+                return
+            # deadline passed mid-answer: keep what arrived
+            budget.skip("searcher", q, "answer cut off at the time budget")
+            answers[q] = {"content": e.text, "sources": [], "images": []}
         except Exception as e:
             answers[q] = {"content": f"Error: {e}", "sources": [], "images": []}
-    return answers
+        finished.add(q)
+        emit({"type": "answer_ready", "question": q, "answer": answers[q]})
+
+    tasks, parallel = [], get_pool().capacity()
+    for i, q in enumerate(questions):
+        call_kwargs = _budgeted_call(budget, q, wave=len(tasks) // parallel)
+        if call_kwargs is None:
+            emit({"type": "question_skipped", "question": q})
+            continue
+        tasks.append(answer(i, q, call_kwargs))
+    try:
+        await asyncio.gather(*tasks)
+    except asyncio.CancelledError:
+        count_metric("questions_skipped", len(tasks) - len(finished))
+        raise
+    return {q: answers[q] for q in questions if q in answers}
+
+
+def searcher_agent(
+    questions: Iterable[str],
+    budget: Budget = None,
+    on_event: Callable[[Dict], None] = None,
+    cancel: CancelToken = None,
+    memory: str = None
+) -> Dict[str, Dict]:
+    """Sync asearcher_agent(); cancel (optional) raises Cancelled."""
+    return run_sync(asearcher_agent(questions, budget, on_event, memory), cancel=cancel)
 
 
 # ===============================================================
@@ -150,18 +245,9 @@ def extract_academic_links(text: str) -> List[str]:
 # ===============================================================
 # STRICT ACADEMIC RESEARCH MODE
 # ===============================================================
-def strict_research_agent(topic: str) -> Dict:
-    prompt = (
-        f"Provide an academic research summary on '{topic}'. "
-        "List peer-reviewed papers with DOI, arXiv, or PDF links "
-        "(IEEE, Springer, Elsevier, PubMed, ACM)."
-    )
+async def astrict_research_agent(topic: str, memory: str = None) -> Dict:
     try:
-        response = local_client.chat.completions.create(
-            model="qwen2.5-7b-instruct-1m-q4",
-            messages=[{"role": "user", "content": prompt}]
-        )
-        content = response.choices[0].message.content
+        content = await agenerate(build_prompt("strict_research", memory=memory, topic=topic))
         papers = extract_academic_links(content)
         return {
             "topic": topic,
@@ -174,20 +260,16 @@ def strict_research_agent(topic: str) -> Dict:
         return {"topic": topic, "summary": f"Error: {e}", "papers": [], "references": [], "images": []}
 
 
+def strict_research_agent(topic: str, cancel: CancelToken = None, memory: str = None) -> Dict:
+    return run_sync(astrict_research_agent(topic, memory), cancel=cancel)
+
+
 # ===============================================================
 # TOP-5 RESEARCH PAPERS
 # ===============================================================
-def top5_research_papers(topic: str) -> Dict:
-    prompt = (
-        f"Find top 5 academic research papers on '{topic}'. "
-        "Return only titles and links (DOI, arXiv, PDF)."
-    )
+async def atop5_research_papers(topic: str, memory: str = None) -> Dict:
     try:
-        response = local_client.chat.completions.create(
-            model="qwen2.5-7b-instruct-1m-q4",
-            messages=[{"role": "user", "content": prompt}]
-        )
-        raw = response.choices[0].message.content
+        raw = await agenerate(build_prompt("top5_papers", memory=memory, topic=topic))
         links = extract_academic_links(raw)
         return {
             "topic": topic,
@@ -199,20 +281,16 @@ def top5_research_papers(topic: str) -> Dict:
         return {"topic": topic, "top_5": [], "top_5_papers": [], "raw_text": f"Error: {e}"}
 
 
+def top5_research_papers(topic: str, cancel: CancelToken = None, memory: str = None) -> Dict:
+    return run_sync(atop5_research_papers(topic, memory), cancel=cancel)
+
+
 # ===============================================================
 # MERGED RESEARCH (WEB + ACADEMIC)
 # ===============================================================
-def merged_research_and_web(topic: str) -> Dict:
-    prompt = (
-        f"Provide complete research on '{topic}'. "
-        "Include academic papers and general web articles with links."
-    )
+async def amerged_research_and_web(topic: str, memory: str = None) -> Dict:
     try:
-        response = local_client.chat.completions.create(
-            model="qwen2.5-7b-instruct-1m-q4",
-            messages=[{"role": "user", "content": prompt}]
-        )
-        content = response.choices[0].message.content
+        content = await agenerate(build_prompt("merged_research", memory=memory, topic=topic))
         links = extract_academic_links(content)
         academic = [l for l in links if any(k in l.lower() for k in ("arxiv", "ieee", "springer", "acm", "pubmed", "scholar"))]
 
@@ -233,3 +311,7 @@ def merged_research_and_web(topic: str) -> Dict:
             "combined_sources": [],
             "images": []
         }
+
+
+def merged_research_and_web(topic: str, cancel: CancelToken = None, memory: str = None) -> Dict:
+    return run_sync(amerged_research_and_web(topic, memory), cancel=cancel)
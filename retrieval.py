@@ -0,0 +1,150 @@
+# -------------------------------------------------
+# retrieval.py — Post-processing of web search results before the LLM
+# -------------------------------------------------
+#
+# Tavily results often repeat the same text (syndicated / mirrored pages),
+# and every repeated sentence costs prefill time on the local model.
+# Pipeline: split into passages -> drop near-duplicates (shingle Jaccard) ->
+# rerank against the query (BM25) -> keep the best within a token budget.
+# Every passage keeps the URL it came from, for citations.
+
+import re
+import math
+from collections import Counter
+from typing import Dict, List
+
+PASSAGE_WORDS = 120          # target passage length
+DUPLICATE_JACCARD = 0.8      # shingle-set similarity at/above which passages are duplicates
+SHINGLE_SIZE = 3
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+_STOPWORDS = {
+    "a", "an", "the", "and", "or", "of", "to", "in", "on", "for", "is", "are",
+    "was", "were", "be", "by", "with", "as", "at", "it", "this", "that", "from",
+    "what", "how", "which", "who", "why", "do", "does", "its", "into", "their",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    return [w for w in _WORD_RE.findall((text or "").lower()) if w not in _STOPWORDS]
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English; good enough for budgeting
+    return max(1, len(text) // 4)
+
+
+# ===============================================================
+# PASSAGE SPLITTING
+# ===============================================================
+def split_passages(text: str, max_words: int = PASSAGE_WORDS) -> List[str]:
+    passages = []
+    for block in re.split(r"\n\s*\n", text or ""):
+        current, count = [], 0
+        for sentence in _SENTENCE_RE.split(block.strip()):
+            words = len(sentence.split())
+            if current and count + words > max_words:
+                passages.append(" ".join(current))
+                current, count = [], 0
+            current.append(sentence)
+            count += words
+        if current and count:
+            passages.append(" ".join(current))
+    return [p for p in passages if p.strip()]
+
+
+# ===============================================================
+# NEAR-DUPLICATE DETECTION (shingle Jaccard)
+# ===============================================================
+# Passages are short (<= PASSAGE_WORDS), so exact Jaccard over word
+# shingles is cheap and, unlike a 64-bit SimHash, is not thrown off by a
+# dropped word or a "Published by ..." prefix on a mirrored copy.
+def shingles(text: str) -> frozenset:
+    words = _WORD_RE.findall((text or "").lower())
+    return frozenset(" ".join(words[i:i + SHINGLE_SIZE]) for i in range(max(1, len(words) - SHINGLE_SIZE + 1)))
+
+
+def jaccard(a: frozenset, b: frozenset) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def dedupe_passages(passages: List[Dict], threshold: float = DUPLICATE_JACCARD) -> List[Dict]:
+    """Keeps the first occurrence of each near-duplicate group."""
+    kept, seen = [], []
+    for p in passages:
+        sh = shingles(p["text"])
+        # sets differing this much in size cannot reach the threshold
+        if any(min(len(sh), len(other)) >= threshold * max(len(sh), len(other)) and jaccard(sh, other) >= threshold
+               for other in seen):
+            continue
+        seen.append(sh)
+        kept.append(p)
+    return kept
+
+
+# ===============================================================
+# RERANKING (BM25 against the query)
+# ===============================================================
+def bm25_scores(query: str, passages: List[Dict], k1: float = 1.5, b: float = 0.75) -> List[float]:
+    q_terms = set(tokenize(query))
+    docs = [tokenize(p["text"]) for p in passages]
+    if not docs or not q_terms:
+        return [0.0] * len(passages)
+
+    avg_len = sum(len(d) for d in docs) / len(docs) or 1.0
+    df = Counter(t for d in docs for t in set(d) if t in q_terms)
+    n = len(docs)
+
+    scores = []
+    for d in docs:
+        tf = Counter(d)
+        score = 0.0
+        for t in q_terms:
+            if not tf[t]:
+                continue
+            idf = math.log(1 + (n - df[t] + 0.5) / (df[t] + 0.5))
+            score += idf * tf[t] * (k1 + 1) / (tf[t] + k1 * (1 - b + b * len(d) / avg_len))
+        scores.append(score)
+    return scores
+
+
+# ===============================================================
+# FULL STAGE
+# ===============================================================
+def select_passages(query: str, results: List[Dict], token_budget: int = 1500) -> List[Dict]:
+    """
+    results: Tavily-style items with 'content', 'url' and optional 'title'.
+    Returns [{'text', 'url', 'title', 'score'}] best-first within token_budget.
+    """
+    passages = []
+    for item in results:
+        for text in split_passages(item.get("content", "")):
+            passages.append({"text": text, "url": item.get("url", ""), "title": item.get("title", "")})
+
+    passages = dedupe_passages(passages)
+    for p, score in zip(passages, bm25_scores(query, passages)):
+        p["score"] = round(score, 4)
+    passages.sort(key=lambda p: p["score"], reverse=True)
+    if passages and passages[0]["score"] > 0:
+        # off-topic passages only cost prefill
+        passages = [p for p in passages if p["score"] > 0]
+
+    selected, used = [], 0
+    for p in passages:
+        cost = estimate_tokens(p["text"])
+        if used + cost > token_budget:
+            continue
+        selected.append(p)
+        used += cost
+    return selected
+
+
+def format_passages(passages: List[Dict]) -> str:
+    """Numbered context block; the model cites passages as [n]."""
+    return "\n\n".join(
+        f"[{i}] {p['text']}\n(Source: {p['url'] or 'unknown'})"
+        for i, p in enumerate(passages, 1)
+    )
@@ -2,27 +2,32 @@
 # WRITER AGENT — Generates research papers or direct answers
 # -------------------------------------------------
 
-from openai import OpenAI, RateLimitError
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.units import inch
-import os
+from openai import RateLimitError
 from dotenv import load_dotenv
 import re
+import time
+import asyncio
+from typing import Callable
+from hedging import ahedged_completion, get_openai_client, OPENAI_MODEL, TruncatedCompletion
+from budget import Budget, estimate, observe
+from profiling import profiled
+from rate_limit import limiter, estimate_tokens, RateLimited
+from cancellation import CancelToken
+from event_loop import run_sync
+from report_renderer import render_pdf
+from prompts import build as build_prompt
 
 # Load environment variables
 load_dotenv()
 
-# Local LM Studio Client
-local_client = OpenAI(
-    base_url="http://localhost:1234/v1",
-    api_key="lm-studio",
-    timeout=180
-)
+# Budgeted runs: below this many seconds the writer skips the LLM entirely
+MIN_WRITER_SECONDS = 5
+COMPACT_MAX_TOKENS = 900
 
-# OpenAI Client
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# OpenAI polish: retries after a transient 429; budgeted runs skip it with
+# less than this many seconds left
+POLISH_RETRIES = 2
+MIN_POLISH_SECONDS = 5
 
 # ---------------------------
 # Helper: Decide if query is simple/factual
@@ -38,101 +43,178 @@ def is_simple_question(query: str) -> bool:
         return True
     return False
 
+# ---------------------------
+# Helper: Report from raw answers (no LLM time left)
+# ---------------------------
+def _stitch_answers(topic: str, qa_pairs: dict = None) -> str:
+    parts = [f"# {topic}"]
+    for question, info in (qa_pairs or {}).items():
+        content = info.get("content", "") if isinstance(info, dict) else str(info)
+        parts.append(f"## {question}\n{content}")
+    if len(parts) == 1:
+        parts.append("No research answers arrived within the time budget.")
+    return "\n\n".join(parts)
+
+# ---------------------------
+# Helper: OpenAI polish
+# ---------------------------
+async def _polish(text: str, budget: Budget = None) -> str:
+    client = get_openai_client()
+    if client is None:
+        return text + "\n\n⚠️ OpenAI polishing failed: OPENAI_API_KEY is not set"
+    polish_messages = build_prompt("polish", text=text)
+    budgeted = budget is not None and not budget.unlimited
+
+    async def call(**call_kwargs):
+        async with limiter("openai").aslot(estimate_tokens(polish_messages), timeout=call_kwargs.get("timeout")) as ticket:
+            polish_res = await client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=polish_messages,
+                **call_kwargs
+            )
+            if polish_res.usage is not None:
+                ticket.set_tokens(polish_res.usage.total_tokens)
+        return polish_res.choices[0].message.content
+
+    for attempt in range(POLISH_RETRIES + 1):
+        call_kwargs = {}
+        if budgeted:
+            if budget.remaining() < MIN_POLISH_SECONDS:
+                budget.skip("writer", "OpenAI polish", "skipped, would exceed time budget")
+                return text
+            call_kwargs["timeout"] = budget.remaining()
+        try:
+            # wall-clock limit; cancelling releases the limiter slot neutrally
+            return await asyncio.wait_for(call(**call_kwargs), call_kwargs.get("timeout"))
+        except (asyncio.TimeoutError, RateLimited):
+            if budgeted:
+                budget.skip("writer", "OpenAI polish", "cut off at the time budget, unpolished text kept")
+            return text
+        except RateLimitError as e:
+            # 429 already halved the OpenAI concurrency limit; back off and
+            # retry unless the account is simply out of quota
+            if attempt < POLISH_RETRIES and getattr(e, "code", None) != "insufficient_quota":
+                await asyncio.sleep(2 ** attempt)
+                continue
+            return text + "\n\n⚠️ OpenAI API quota finished. Using raw LM Studio output."
+        except Exception as e:
+            return text + f"\n\n⚠️ OpenAI polishing failed: {str(e)}"
+    return text
+
 # ---------------------------
 # WRITER AGENT FUNCTION
 # ---------------------------
-def writer_agent(topic: str, qa_pairs: dict = None, use_openai: bool = False, mode: str = "normal") -> str:
+async def awriter_agent(
+    topic: str,
+    qa_pairs: dict = None,
+    use_openai: bool = False,
+    mode: str = "normal",
+    budget: Budget = None,
+    on_token: Callable[[str], None] = None,
+    memory: str = None
+) -> str:
     """
     Generates structured research paper OR a direct answer depending on mode.
     
-    mode: 'normal', 'deep_research', 'academic', 'factual'
+    mode: the UI mode ('normal', 'code', 'deep research') or 'factual';
+          selects the hedge deadline budget
+    budget: optional Budget; a short budget switches to a compact report,
+            an exhausted one stitches the retrieved answers together.
+    on_token: optional callback receiving base-text tokens as they stream.
+    memory: optional conversation context block for follow-up queries.
     """
+    budgeted = budget is not None and not budget.unlimited
+    compact = budgeted and budget.remaining() < estimate("writer")
+    call_kwargs = {"timeout": budget.remaining()} if budgeted else {}
+
+    # ---------------------------
+    # 0️⃣ No time left: best-effort report from retrieved answers
+    # ---------------------------
+    if budgeted and budget.remaining() < MIN_WRITER_SECONDS:
+        budget.skip("writer", "LLM report generation", "no time left, raw answers returned")
+        return _stitch_answers(topic, qa_pairs)
 
     # ---------------------------
     # 1️⃣ Simple factual answer mode
     # ---------------------------
-    if mode == "factual" or is_simple_question(topic):
-        prompt = f"Answer concisely in 1-2 sentences:\n\nQuestion: {topic}"
+    # Instructions and structure live in the template's fixed system
+    # prefix (prompt-cache friendly); topic and retrieved data come last.
+    factual = mode == "factual" or is_simple_question(topic)
+    if factual:
+        messages = build_prompt("writer_factual", memory=memory, topic=topic)
+    elif compact:
+        budget.skip("writer", "Types, Key Features, Architecture, Examples, Glossary, References",
+                    "compact report to fit time budget")
+        call_kwargs["max_tokens"] = COMPACT_MAX_TOKENS
+        messages = build_prompt("writer_compact", memory=memory, topic=topic, context=qa_pairs or {})
     else:
         # ---------------------------
         # 2️⃣ Full research paper mode
         # ---------------------------
-        prompt = f"""
-You are an expert AI research writer.
-
-Write a complete research document on:
-**{topic}**
-
-Use the following retrieved information:
-{qa_pairs or {}}
-
-Follow this structure exactly:
-
-1. Definition
-2. Explanation (Detailed)
-3. TYPES (Detailed)
-4. Key Features
-5. Pros
-6. Cons
-7. Applications / Use Cases
-8. Architecture / Flow Diagram (ASCII)
-9. Examples
-10. Glossary
-11. References
-12. Final Summary
-"""
+        messages = build_prompt("writer_full", memory=memory, topic=topic, context=qa_pairs or {})
 
     # ---------------------------
-    # Generate base text using LM Studio
+    # Generate base text using LM Studio (hedged to OpenAI when slow)
     # ---------------------------
+    hedge_mode = "factual" if factual else mode
+    started = time.monotonic()
     try:
-        response = local_client.chat.completions.create(
-            model="qwen2.5-7b-instruct-1m-q4",
-            messages=[{"role": "user", "content": prompt}]
-        )
-        text = response.choices[0].message.content
+        text, _backend = await ahedged_completion(messages, mode=hedge_mode, on_token=on_token, **call_kwargs)
+        if not factual and not compact:
+            observe("writer", time.monotonic() - started)
+    except TruncatedCompletion as e:
+        # keep what streamed, but say the report is cut short
+        if budgeted and isinstance(e.__cause__, TimeoutError):
+            budget.skip("writer", "rest of the report", "cut off at the time budget")
+            text = e.text
+        else:
+            text = f"{e.text}\n\n⚠️ {e.backend} generation stopped early: {e.__cause__}"
     except Exception as e:
+        if budgeted and qa_pairs:
+            budget.skip("writer", "LLM report generation", f"failed ({e}), raw answers returned")
+            return _stitch_answers(topic, qa_pairs)
         text = f"⚠️ LM Studio generation failed: {str(e)}"
 
     # ---------------------------
     # Optional: Polish using OpenAI GPT
     # ---------------------------
-    if use_openai and not is_simple_question(topic):
-        polish_prompt = f"Improve clarity, structure, and readability of this research document:\n\n{text}"
-        try:
-            polish_res = openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": polish_prompt}]
-            )
-            text = polish_res.choices[0].message.content
-        except RateLimitError:
-            text += (
-                "\n\n⚠️ OpenAI API quota finished. Using raw LM Studio output."
-            )
-        except Exception as e:
-            text += f"\n\n⚠️ OpenAI polishing failed: {str(e)}"
+    if use_openai and not is_simple_question(topic) and not compact:
+        text = await _polish(text, budget)
 
     # ---------------------------
     # Cleanup: Remove redundant newlines
     # ---------------------------
-    text = re.sub(r"\n{3,}", "\n\n", text).strip()
-    return text
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+@profiled("writer_agent")
+def writer_agent(
+    topic: str,
+    qa_pairs: dict = None,
+    use_openai: bool = False,
+    mode: str = "normal",
+    budget: Budget = None,
+    on_token: Callable[[str], None] = None,
+    cancel: CancelToken = None,
+    memory: str = None
+) -> str:
+    """
+    Sync awriter_agent(). on_token is called from the agents loop thread;
+    cancel (optional CancelToken) raises Cancelled and closes the streams.
+    """
+    return run_sync(
+        awriter_agent(topic, qa_pairs, use_openai, mode, budget, on_token, memory),
+        cancel=cancel
+    )
 
 # ---------------------------
 # PDF GENERATOR
 # ---------------------------
+@profiled("generate_pdf")
 def generate_pdf(text: str, filename: str = "research_output.pdf") -> str:
     """
     Generates a PDF from the provided text. Returns PDF filename.
+    (Kept for callers that want a file; the app uses render_pdf() bytes.)
     """
-    styles = getSampleStyleSheet()
-    story = []
-    doc = SimpleDocTemplate(filename, pagesize=A4)
-
-    for line in text.split("\n"):
-        if line.strip():
-            story.append(Paragraph(line, styles["Normal"]))
-            story.append(Spacer(1, 0.2 * inch))
-
-    doc.build(story)
+    with open(filename, "wb") as fh:
+        fh.write(render_pdf(text))
     return filename